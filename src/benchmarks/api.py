@@ -0,0 +1,271 @@
+"""Нагрузочные и микро замеры апи на синтетических данных. Запускается из src с тем же DATABASE_URL, что и апи.
+
+    python -m benchmarks.api seed --users 1000 --posts 10000
+    python -m benchmarks.api load --concurrency 50 --output results.json
+    python -m benchmarks.api load --url http://0.0.0.0:8000 --scenarios feed,read
+    python -m benchmarks.api micro --fake-redis --output micro.json
+    python -m benchmarks.api compare base.json results.json
+"""
+import asyncio
+import json
+import random
+import sys
+import time
+
+import click
+from sqlalchemy.engine import make_url
+
+from benchmarks.utils import print_report, run_concurrently, save_results, use_fake_redis
+
+SCENARIOS = ('feed', 'feed_summary', 'read', 'like', 'login', 'edit')
+FEED_PAGE_SIZE = 20
+
+fake_redis_option = click.option('--fake-redis', is_flag=True, help='fakeredis вместо редиса из настроек')
+seed_option = click.option('--seed', default=42, show_default=True, help='Seed генератора синтетических данных')
+skew_option = click.option('--skew', default=1.1, show_default=True,
+                           help='Неравномерность популярности постов (показатель закона Ципфа)')
+
+
+def _run_meta(fake_redis: bool, **params) -> dict:
+    from config.base import settings
+
+    return {'database': make_url(settings.DATABASE_URL).get_backend_name(),
+            'redis': 'fakeredis' if fake_redis else 'redis', **params}
+
+
+def _load_dataset(skew: float, seed: int):
+    from benchmarks.dataset import load_dataset
+    from config.db import SessionLocal
+
+    try:
+        return load_dataset(db=SessionLocal(), skew=skew, seed=seed)
+    except ValueError as err:
+        raise click.ClickException(str(err))
+    finally:
+        SessionLocal.remove()
+
+
+def build_scenarios(client, dataset, rng: random.Random) -> dict:
+    """Запросы сценариев нагрузки. Посты выбираются с учетом популярности, как у реальной ленты"""
+    from benchmarks.dataset import BENCH_PASSWORD
+    from users.utils import create_token
+
+    tokens = {user_id: {'Authorization': f'Bearer {create_token(username, uid=user_id)}'}
+              for user_id, username in dataset.users}
+    usernames = dict(dataset.users)
+    post_ids = sorted(post_id for post_id, _ in dataset.posts)
+
+    async def request(method: str, url: str, **kwargs) -> None:
+        response = await client.request(method, url, **kwargs)
+        response.raise_for_status()
+
+    def feed_page(**params) -> dict:
+        after_id = rng.choice(post_ids[:-FEED_PAGE_SIZE] or post_ids) if rng.random() < 0.5 else None
+        return {'limit': FEED_PAGE_SIZE, **({'after_id': after_id} if after_id else {}), **params}
+
+    async def feed() -> None:
+        await request('GET', '/api/posts/', params=feed_page())
+
+    async def feed_summary() -> None:
+        await request('GET', '/api/posts/', params=feed_page(summary='true'))
+
+    async def read() -> None:
+        post_id, _ = dataset.popular_post(rng)
+        await request('GET', f'/api/posts/{post_id}')
+
+    async def like() -> None:
+        (user_id, _), post_id = dataset.reaction_pair(rng)
+        await request('POST', f'/api/posts/like/{post_id}', headers=tokens[user_id])
+
+    async def login() -> None:
+        _, username = rng.choice(dataset.users)
+        await request('POST', '/api/users/login', data={'username': username, 'password': BENCH_PASSWORD})
+
+    async def edit() -> None:
+        post_id, author = dataset.popular_post(rng)
+        await request('PATCH', f'/api/posts/{post_id}', json={'title': f'Edited by {usernames[author]}'},
+                      headers=tokens[author])
+
+    return {'feed': feed, 'feed_summary': feed_summary, 'read': read, 'like': like, 'login': login, 'edit': edit}
+
+
+@click.group()
+def cli() -> None:
+    """Замеры пропускной способности и задержки апи"""
+
+
+@cli.command('seed')
+@click.option('--users', default=1000, show_default=True)
+@click.option('--posts', default=10000, show_default=True)
+@click.option('--reactions-per-user', default=50, show_default=True)
+@click.option('--description-length', default=1000, show_default=True)
+@click.option('--dislike-ratio', default=0.2, show_default=True)
+@skew_option
+@seed_option
+def seed(users: int, posts: int, reactions_per_user: int, description_length: int, dislike_ratio: float,
+         skew: float, seed: int) -> None:
+    """Создает таблицы и заполняет пустую бд синтетическими юзерами, постами и реакциями"""
+    from benchmarks.dataset import seed_dataset
+    from config.db import Base, SessionLocal, engine
+
+    Base.metadata.create_all(bind=engine)
+    started = time.perf_counter()
+    try:
+        dataset = seed_dataset(db=SessionLocal(), users=users, posts=posts, reactions_per_user=reactions_per_user,
+                               description_length=description_length, skew=skew, dislike_ratio=dislike_ratio,
+                               seed=seed)
+    except ValueError as err:
+        raise click.ClickException(str(err))
+    finally:
+        SessionLocal.remove()
+    click.echo(f'Seeded {len(dataset.users)} users and {len(dataset.posts)} posts '
+               f'in {time.perf_counter() - started:.1f}s')
+
+
+@cli.command('load')
+@click.option('--url', default=None, help='Адрес запущенного апи. По умолчанию приложение запускается в процессе')
+@click.option('--scenarios', default=','.join(SCENARIOS), show_default=True)
+@click.option('--requests', default=1000, show_default=True, help='Количество запросов на сценарий')
+@click.option('--concurrency', default=50, show_default=True)
+@click.option('--warmup', default=100, show_default=True, help='Запросы до замера, прогревают кэши')
+@click.option('--output', default=None, help='Файл для результатов в json')
+@fake_redis_option
+@skew_option
+@seed_option
+def load(url: str | None, scenarios: str, requests: int, concurrency: int, warmup: int, output: str | None,
+         fake_redis: bool, skew: float, seed: int) -> None:
+    """Нагрузка на ленту, чтение поста, лайк, вход и редактирование поста по очереди"""
+    import httpx
+
+    names = [name.strip() for name in scenarios.split(',') if name.strip()]
+    unknown = set(names) - set(SCENARIOS)
+    if unknown:
+        raise click.BadParameter(f'unknown scenarios: {", ".join(sorted(unknown))}', param_hint='--scenarios')
+    if fake_redis:
+        if url:
+            raise click.UsageError('--fake-redis works only with the in-process app')
+        use_fake_redis()
+    dataset = _load_dataset(skew=skew, seed=seed)
+
+    async def run_scenarios(client) -> dict:
+        results = {}
+        scenario_calls = build_scenarios(client=client, dataset=dataset, rng=random.Random(seed))
+        for name in names:
+            if warmup:
+                await run_concurrently(scenario_calls[name], warmup, concurrency)
+            report = await run_concurrently(scenario_calls[name], requests, concurrency)
+            results[f'load.{name}'] = print_report(name, *report)
+        return results
+
+    async def main() -> dict:
+        if url:
+            async with httpx.AsyncClient(base_url=url, timeout=30) as client:
+                return await run_scenarios(client)
+
+        from main import app
+        async with app.router.lifespan_context(app), httpx.AsyncClient(app=app, base_url='http://benchmark') as client:
+            return await run_scenarios(client)
+
+    results = asyncio.run(main())
+    if output:
+        save_results(output, results, **_run_meta(fake_redis, mode='remote' if url else 'in-process',
+                                                  requests=requests, concurrency=concurrency, warmup=warmup))
+
+
+@cli.command('micro')
+@click.option('--iterations', default=500, show_default=True)
+@click.option('--flush-iterations', default=20, show_default=True, help='Сколько раз замеряется update_db')
+@click.option('--flush-batch', default=500, show_default=True, help='Сколько реакций переносит один update_db')
+@click.option('--output', default=None, help='Файл для результатов в json')
+@fake_redis_option
+@skew_option
+@seed_option
+def micro(iterations: int, flush_iterations: int, flush_batch: int, output: str | None, fake_redis: bool,
+          skew: float, seed: int) -> None:
+    """Последовательные замеры fetch_one_post, change_count_of_users_emotions и update_db без http"""
+    if fake_redis:
+        use_fake_redis()
+    dataset = _load_dataset(skew=skew, seed=seed)
+
+    from config.base import manager
+    from config.db import AsyncSessionLocal, async_engine
+    from posts.cache import change_count_of_users_emotions
+    from posts.models import Likes
+    from posts.services import fetch_one_post
+    from posts.tasks import update_db
+    from users.schemas import TokenData
+
+    rng = random.Random(seed)
+
+    async def fetch() -> None:
+        async with AsyncSessionLocal() as db:
+            await fetch_one_post(db=db, post_id=dataset.popular_post(rng)[0])
+
+    async def toggle() -> None:
+        (user_id, username), post_id = dataset.reaction_pair(rng)
+        async with AsyncSessionLocal() as db:
+            response = await change_count_of_users_emotions(db=db, user=TokenData(username=username, id=user_id),
+                                                            post_id=post_id, users='like_user', model=Likes)
+        if response.status_code >= 400:
+            raise RuntimeError(response.body)
+
+    async def main() -> dict:
+        results = {'micro.fetch_one_post': print_report('fetch_one_post',
+                                                        *await run_concurrently(fetch, iterations, 1)),
+                   'micro.change_count_of_users_emotions': print_report(
+                       'change_count_of_users_emotions', *await run_concurrently(toggle, iterations, 1))}
+
+        # Каждый замер update_db переносит в бд flush_batch свежих реакций из журнала
+        update_db()
+        latencies, errors = [], 0
+        for _ in range(flush_iterations):
+            await run_concurrently(toggle, flush_batch, 1)
+            started = time.perf_counter()
+            try:
+                update_db()
+                latencies.append(time.perf_counter() - started)
+            except Exception:
+                errors += 1
+        results['micro.update_db'] = print_report(f'update_db ({flush_batch} reactions)', latencies,
+                                                  sum(latencies), errors)
+
+        await async_engine.dispose()
+        await manager.redis.close()
+        return results
+
+    results = asyncio.run(main())
+    if output:
+        save_results(output, results, **_run_meta(fake_redis, iterations=iterations,
+                                                  flush_iterations=flush_iterations, flush_batch=flush_batch))
+
+
+@cli.command('compare')
+@click.argument('baseline', type=click.File())
+@click.argument('current', type=click.File())
+@click.option('--threshold', default=10.0, show_default=True,
+              help='Допустимый рост p95 в процентах, при превышении код возврата 1')
+def compare(baseline, current, threshold: float) -> None:
+    """Сравнивает два json с результатами, например до и после изменения"""
+    baseline, current = json.load(baseline), json.load(current)
+    click.echo(f'{baseline["meta"].get("commit")} -> {current["meta"].get("commit")}')
+
+    regressions = []
+    for name, result in current['results'].items():
+        base = baseline['results'].get(name)
+        if not base or 'p95_ms' not in base or 'p95_ms' not in result:
+            continue
+        changes = []
+        for metric in ('rps', 'p50_ms', 'p95_ms', 'p99_ms'):
+            change = (result[metric] - base[metric]) / base[metric] * 100 if base[metric] else 0
+            changes.append(f'{metric} {base[metric]} -> {result[metric]} ({change:+.1f}%)')
+            if metric == 'p95_ms' and change > threshold:
+                regressions.append(name)
+        click.echo(f'{name}: ' + ', '.join(changes))
+
+    if regressions:
+        click.echo(f'p95 regressed more than {threshold}%: {", ".join(regressions)}', err=True)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    cli()
@@ -0,0 +1,105 @@
+import random
+from dataclasses import dataclass, field
+
+from sqlalchemy import func, insert, select
+from sqlalchemy.orm import Session
+
+from posts.models import Post, Likes, Dislikes
+from posts.services import recount_reactions_counters
+from users.models import User
+from users.passwords import pwd_context
+
+# У всех синтетических юзеров один пароль, чтобы замер входа не зависел от данных
+BENCH_PASSWORD = 'Passw0rd1'
+BENCH_USER_PREFIX = 'bench_user_'
+INSERT_BATCH_SIZE = 5000
+
+
+@dataclass
+class Dataset:
+    """Айди синтетических юзеров и постов. Посты упорядочены по популярности: чем раньше в списке,
+    тем чаще его читают и лайкают"""
+    users: list[tuple[int, str]]
+    posts: list[tuple[int, int]]
+    skew: float
+    weights: list[float] = field(init=False)
+
+    def __post_init__(self) -> None:
+        self.weights = popularity_weights(len(self.posts), self.skew)
+
+    def popular_post(self, rng: random.Random) -> tuple[int, int]:
+        """Айди и автор поста, выбранного с учетом популярности"""
+        return rng.choices(self.posts, weights=self.weights)[0]
+
+    def reaction_pair(self, rng: random.Random) -> tuple[tuple[int, str], int]:
+        """Юзер и популярный пост другого автора, на который он может поставить реакцию"""
+        while True:
+            user = rng.choice(self.users)
+            post_id, author = self.popular_post(rng)
+            if author != user[0]:
+                return user, post_id
+
+
+def popularity_weights(count: int, skew: float) -> list[float]:
+    """Веса по закону Ципфа: пост на месте n выбирается в n^skew раз реже первого"""
+    return [1 / (rank ** skew) for rank in range(1, count + 1)]
+
+
+def _by_popularity(posts: list, seed: int) -> list[tuple[int, int]]:
+    """Перемешивает посты по seed, чтобы популярность не зависела от айди. При одном seed порядок тот же"""
+    posts = sorted(tuple(row) for row in posts)
+    random.Random(seed).shuffle(posts)
+    return posts
+
+
+def _insert_in_batches(db: Session, model, rows: list[dict]) -> None:
+    for start in range(0, len(rows), INSERT_BATCH_SIZE):
+        db.execute(insert(model), rows[start:start + INSERT_BATCH_SIZE])
+
+
+def seed_dataset(db: Session, users: int, posts: int, reactions_per_user: int, description_length: int,
+                 skew: float, dislike_ratio: float, seed: int) -> Dataset:
+    """Заполняет бд синтетическими юзерами, постами и реакциями. Реакции распределены неравномерно:
+    большая часть приходится на небольшое количество популярных постов. Счетчики постов пересчитываются в конце"""
+    if db.scalar(select(func.count(User.id)).where(User.username.startswith(BENCH_USER_PREFIX))):
+        raise ValueError('Benchmark dataset already exists, use a fresh database')
+
+    rng = random.Random(seed)
+    hashed_password = pwd_context.hash(BENCH_PASSWORD)
+    offset = db.scalar(select(func.max(User.id))) or 0
+    _insert_in_batches(db, User, [{'username': f'{BENCH_USER_PREFIX}{offset + i}',
+                                   'email': f'bench{offset + i}@example.com',
+                                   'hashed_password': hashed_password} for i in range(users)])
+    user_ids = db.scalars(select(User.id).where(User.username.startswith(BENCH_USER_PREFIX))).all()
+
+    _insert_in_batches(db, Post, [{'title': f'Post {i}',
+                                   'description': ''.join(rng.choices('abcdef ', k=description_length)),
+                                   'author': rng.choice(user_ids)} for i in range(posts)])
+    post_rows = _by_popularity(db.execute(select(Post.id, Post.author).where(Post.author.in_(user_ids))), seed)
+    weights = popularity_weights(len(post_rows), skew)
+
+    likes, dislikes = [], []
+    for user_id in user_ids:
+        reacted = set()
+        for post_id, author in rng.choices(post_rows, weights=weights, k=reactions_per_user * 2):
+            if len(reacted) == reactions_per_user:
+                break
+            if author == user_id or post_id in reacted:
+                continue
+            reacted.add(post_id)
+            (dislikes if rng.random() < dislike_ratio else likes).append({'post_id': post_id, 'user': user_id})
+    _insert_in_batches(db, Likes, likes)
+    _insert_in_batches(db, Dislikes, dislikes)
+    db.execute(recount_reactions_counters(post_ids=[post_id for post_id, _ in post_rows]))
+    db.commit()
+    return load_dataset(db=db, skew=skew, seed=seed)
+
+
+def load_dataset(db: Session, skew: float, seed: int) -> Dataset:
+    """Читает айди синтетических юзеров и постов из бд. Порядок популярности восстанавливается тем же seed"""
+    users = db.execute(select(User.id, User.username).where(User.username.startswith(BENCH_USER_PREFIX))
+                       .order_by(User.id)).all()
+    if not users:
+        raise ValueError('Benchmark dataset not found, run the seed command first')
+    posts = db.execute(select(Post.id, Post.author).where(Post.author.in_([user.id for user in users])))
+    return Dataset(users=[tuple(row) for row in users], posts=_by_popularity(posts, seed), skew=skew)
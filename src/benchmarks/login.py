@@ -0,0 +1,72 @@
+"""Нагрузочные замеры входа юзеров.
+
+    python -m benchmarks.login http --url http://0.0.0.0:8000 --username alice --password Passw0rd1
+    python -m benchmarks.login hashing --rounds 12
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+import aiohttp
+import click
+
+from benchmarks.utils import print_report, run_concurrently
+
+
+@click.group()
+def cli() -> None:
+    """Замеры пропускной способности и задержки входа"""
+
+
+@cli.command('http')
+@click.option('--url', default='http://0.0.0.0:8000')
+@click.option('--username', required=True)
+@click.option('--password', required=True)
+@click.option('--requests', default=200, show_default=True)
+@click.option('--concurrency', default=50, show_default=True)
+def http(url: str, username: str, password: str, requests: int, concurrency: int) -> None:
+    """Шлет запросы на /api/users/login запущенного приложения"""
+    async def main() -> None:
+        async with aiohttp.ClientSession() as session:
+            async def login() -> None:
+                async with session.post(f'{url}/api/users/login',
+                                        data={'username': username, 'password': password}) as response:
+                    response.raise_for_status()
+                    await response.read()
+
+            report = await run_concurrently(login, requests, concurrency)
+        print_report('login', *report)
+
+    asyncio.run(main())
+
+
+@cli.command('hashing')
+@click.option('--rounds', default=None, type=int, help='По умолчанию BCRYPT_ROUNDS из настроек')
+@click.option('--requests', default=50, show_default=True)
+@click.option('--concurrency', default=16, show_default=True)
+def hashing(rounds: int | None, requests: int, concurrency: int) -> None:
+    """Сравнивает проверку пароля bcrypt в тредпуле и в пуле процессов приложения"""
+    from users import passwords
+
+    context = passwords.pwd_context.copy(bcrypt__rounds=rounds) if rounds else passwords.pwd_context
+    passwords.pwd_context = context
+    hashed = context.hash('Passw0rd1')
+
+    async def main() -> None:
+        loop = asyncio.get_running_loop()
+        with ThreadPoolExecutor() as threads:
+            async def in_threads() -> None:
+                await loop.run_in_executor(threads, context.verify, 'Passw0rd1', hashed)
+
+            print_report('threadpool', *await run_concurrently(in_threads, requests, concurrency))
+
+        async def in_processes() -> None:
+            await passwords.verify_password('Passw0rd1', hashed)
+
+        print_report('process pool', *await run_concurrently(in_processes, requests, concurrency))
+        await passwords.shutdown_password_hashing()
+
+    asyncio.run(main())
+
+
+if __name__ == '__main__':
+    cli()
@@ -0,0 +1,74 @@
+"""Замеры холодного старта апи: импорт приложения и время до первого ответа запущенного uvicorn.
+
+    python -m benchmarks.startup --repeats 5 --output startup.json
+"""
+import socket
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+
+import click
+
+from benchmarks.utils import print_report, save_results
+
+IMPORT_SCRIPT = 'import time; started = time.perf_counter(); import main; print(time.perf_counter() - started)'
+
+
+def measure_import() -> float:
+    """Время импорта main (сборка приложения) в чистом интерпретаторе"""
+    result = subprocess.run([sys.executable, '-c', IMPORT_SCRIPT], capture_output=True, text=True, check=True)
+    return float(result.stdout.strip().splitlines()[-1])
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def measure_first_response(timeout: float) -> float:
+    """Время от запуска процесса uvicorn до первого успешного ответа апи"""
+    port = _free_port()
+    started = time.perf_counter()
+    server = subprocess.Popen([sys.executable, '-m', 'uvicorn', 'main:app', '--port', str(port)],
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        while time.perf_counter() - started < timeout:
+            if server.poll() is not None:
+                raise RuntimeError(f'uvicorn exited with code {server.returncode}')
+            try:
+                with urllib.request.urlopen(f'http://127.0.0.1:{port}/openapi.json', timeout=1):
+                    return time.perf_counter() - started
+            except (urllib.error.URLError, ConnectionError):
+                time.sleep(0.01)
+        raise TimeoutError(f'No response in {timeout}s')
+    finally:
+        server.terminate()
+        server.wait()
+
+
+@click.command()
+@click.option('--repeats', default=5, show_default=True)
+@click.option('--timeout', default=30.0, show_default=True, help='Сколько секунд ждать первого ответа')
+@click.option('--output', default=None, help='Файл для результатов в json')
+def cli(repeats: int, timeout: float, output: str | None) -> None:
+    """Замеряет холодный старт апи. Запускается из src с теми же настройками, что и апи"""
+    results = {}
+    for name, measure in (('import', measure_import), ('first_response', lambda: measure_first_response(timeout))):
+        latencies, errors = [], 0
+        for _ in range(repeats):
+            try:
+                latencies.append(measure())
+            except (RuntimeError, TimeoutError, subprocess.CalledProcessError) as err:
+                click.echo(err, err=True)
+                errors += 1
+        results[f'startup.{name}'] = print_report(name, latencies, sum(latencies), errors)
+
+    if output:
+        save_results(output, results, repeats=repeats)
+
+
+if __name__ == '__main__':
+    cli()
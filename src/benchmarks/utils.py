@@ -0,0 +1,94 @@
+import asyncio
+import json
+import platform
+import statistics
+import subprocess
+import time
+from datetime import datetime, timezone
+
+import click
+
+
+def summarize(latencies: list[float], elapsed: float, errors: int = 0) -> dict:
+    """Пропускная способность и перцентили задержки в миллисекундах"""
+    summary = {'ok': len(latencies), 'errors': errors, 'elapsed_s': round(elapsed, 3),
+               'rps': round(len(latencies) / elapsed, 1) if elapsed else None}
+    if latencies:
+        quantiles = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else latencies * 99
+        summary.update(mean_ms=round(statistics.fmean(latencies) * 1000, 3),
+                       p50_ms=round(quantiles[49] * 1000, 3), p95_ms=round(quantiles[94] * 1000, 3),
+                       p99_ms=round(quantiles[98] * 1000, 3))
+    return summary
+
+
+def print_report(name: str, latencies: list[float], elapsed: float, errors: int = 0) -> dict:
+    """Печатает пропускную способность и перцентили задержки, возвращает их же для сохранения в json"""
+    summary = summarize(latencies, elapsed, errors)
+    if not latencies:
+        click.echo(f'{name}: no successful requests, {errors} errors')
+    else:
+        click.echo(f'{name}: {summary["ok"]} ok, {errors} errors, {summary["rps"]:.1f} req/s, '
+                   f'p50={summary["p50_ms"]:.1f}ms p95={summary["p95_ms"]:.1f}ms p99={summary["p99_ms"]:.1f}ms')
+    return summary
+
+
+async def run_concurrently(func, requests: int, concurrency: int) -> tuple[list[float], float, int]:
+    """Выполняет func requests раз не больше concurrency одновременно. Возвращает задержки успешных вызовов,
+    общее время и количество ошибок"""
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies, errors = [], 0
+
+    async def timed() -> None:
+        nonlocal errors
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                await func()
+                latencies.append(time.perf_counter() - started)
+            except Exception:
+                errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(timed() for _ in range(requests)))
+    return latencies, time.perf_counter() - started, errors
+
+
+def use_fake_redis() -> None:
+    """Подменяет клиенты редиса на fakeredis с общим хранилищем. Вызывается до импорта модулей приложения,
+    так как они запоминают клиент при импорте"""
+    try:
+        import fakeredis
+        from fakeredis import aioredis
+    except ImportError:
+        raise click.UsageError('--fake-redis requires fakeredis and lupa: pip install fakeredis lupa')
+
+    from config.base import ConnectionManager, manager
+    from config.breaker import BreakerRedis
+
+    server = fakeredis.FakeServer()
+    cache = aioredis.FakeRedis(server=server, decode_responses=True)
+    ConnectionManager.redis = BreakerRedis(connection_pool=cache.connection_pool, breaker=manager.redis_breaker)
+    binary_cache = aioredis.FakeRedis(server=server)
+    ConnectionManager.binary_redis = BreakerRedis(connection_pool=binary_cache.connection_pool,
+                                                  breaker=manager.redis_breaker)
+    ConnectionManager.pubsub_redis = aioredis.FakeRedis(server=server, decode_responses=True)
+    ConnectionManager.sync_redis = fakeredis.FakeRedis(server=server, decode_responses=True)
+    ConnectionManager.sync_binary_redis = fakeredis.FakeRedis(server=server)
+
+
+def current_commit() -> str | None:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def save_results(path: str, results: dict[str, dict], **meta) -> None:
+    """Сохраняет результаты замеров вместе с коммитом и параметрами запуска, чтобы сравнивать их между коммитами"""
+    report = {'meta': {'commit': current_commit(), 'created_at': datetime.now(timezone.utc).isoformat(),
+                       'python': platform.python_version(), **meta},
+              'results': results}
+    with open(path, 'w') as file:
+        json.dump(report, file, indent=2)
+    click.echo(f'Results saved to {path}')
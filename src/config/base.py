@@ -1,8 +1,13 @@
 import pathlib
-import redis
+from functools import cached_property
+
+from redis import Redis
+from redis.asyncio import Redis as AsyncRedis
 
 from pydantic import BaseSettings, Field
 
+from config.breaker import BreakerRedis, CircuitBreaker
+
 
 class AppSettings(BaseSettings):
     class Config:
@@ -10,34 +15,159 @@ class AppSettings(BaseSettings):
         env_file_encoding = "utf-8"
 
     BASE_DIR: pathlib.Path = pathlib.Path(__file__).parent
-    DATABASE_URL: str = f"sqlite:///{BASE_DIR}/social.db"
+    DATABASE_URL: str = f"sqlite:///{BASE_DIR.parent}/social.db"
+    DB_POOL_SIZE: int = 10
+    DB_MAX_OVERFLOW: int = 20
+    DB_POOL_TIMEOUT: int = 30
+    DB_POOL_RECYCLE: int = 1800  # В секундах, меньше чем idle timeout у pgbouncer/postgres
+    DB_POOL_PRE_PING: bool = True
+    SQLITE_BUSY_TIMEOUT: int = 5000  # В миллисекундах
     REDIS_PORT: int = '6379'
+    REDIS_SOCKET_TIMEOUT: float = 0.25  # Таймаут команды к редису-кэшу из апи, в секундах
+    REDIS_CONNECT_TIMEOUT: float = 0.25
+    REDIS_BREAKER_FAILURE_THRESHOLD: int = 5  # Сколько ошибок подряд размыкают предохранитель
+    REDIS_BREAKER_RECOVERY_TIMEOUT: float = 5.0  # Сколько секунд запросы идут сразу в бд после размыкания
+    REDIS_HEALTH_PROBE_INTERVAL: float = 1.0
     HUNTER_URL: str = "https://api.hunter.io/v2/email-verifier"
-    HUNTER_API_KEY: str = Field(..., env='HUNTER_API_KEY')
+    # Ключи внешних апи нужны только процессам, которые проверяют регистрации, и проверяются при их запуске
+    HUNTER_API_KEY: str | None = Field(None, env='HUNTER_API_KEY')
     CLEARBIT_URL: str = "https://risk.clearbit.com/v1/calculate"
-    CLEARBIT_API_KEY: str = Field(..., env='CLEARBIT_API_KEY')
+    CLEARBIT_API_KEY: str | None = Field(None, env='CLEARBIT_API_KEY')
+    EXTERNAL_API_TIMEOUT: float = 5.0  # Общий таймаут запроса к hunter/clearbit, в секундах
+    EXTERNAL_API_CONNECT_TIMEOUT: float = 2.0
+    EXTERNAL_API_CONNECTIONS: int = 100
+    SIGNUP_VERDICT_TTL: int = 86400  # Сколько секунд хранятся ответы hunter/clearbit по емейлу/домену
+    # Если включено, то аккаунт создается сразу в статусе pending, а hunter/clearbit проверяют его celery таски
+    SIGNUP_ASYNC_VERIFICATION: bool = False
+    SIGNUP_VERIFICATION_BATCH_SIZE: int = 50
+    SIGNUP_VERIFICATION_CONCURRENCY: int = 5  # Сколько юзеров из пачки проверяется одновременно
+    SIGNUP_VERIFICATION_RATE_LIMIT: str = '30/m'  # Ограничение запусков таски проверки на воркер
     SECRET: str = Field(..., env='SECRET')
     ALGORITHM: str = "HS256"
     ACCESS: int = 30
+    BCRYPT_ROUNDS: int = 12  # При изменении старые хэши пересчитываются при входе юзера
+    PASSWORD_HASHING_WORKERS: int = 2  # Процессов в пуле для bcrypt
+    PASSWORD_HASHING_MAX_PENDING: int = 64  # Сверх этого количества задач в очереди запросы получают 503
+    LOGIN_MAX_FAILURES: int = 5  # После стольких неверных паролей подряд вход блокируется на LOGIN_FAILURES_WINDOW
+    LOGIN_FAILURES_WINDOW: int = 300  # В секундах
+    LOGIN_UNKNOWN_USER_TTL: int = 60  # Сколько секунд помнить, что такого логина нет
+    USER_CACHE_TTL: int = 60  # Время жизни данных юзера в редисе, в секундах
+    USER_LOCAL_CACHE_TTL: float = 5.0  # Время жизни данных юзера в локальном кэше воркера, в секундах
+    USER_LOCAL_CACHE_MAX_ITEMS: int = 10000
 
+    BULK_MAX_ITEMS: int = 500  # Максимум постов/реакций в одном пакетном запросе
+    EXPORT_BATCH_SIZE: int = 1000  # Сколько строк за раз забирается из курсора при выгрузке постов
     TTL: int = 168  # Дефолтное значение в редисе (1 неделя)
-    DAY_SECONDS: int = 86400
+    CACHE_LOCK_TIMEOUT: int = 3000  # Лок на загрузку поста из бд в кэш, в миллисекундах
+    CACHE_LOCK_WAIT_ATTEMPTS: int = 10
+    CACHE_LOCK_WAIT_INTERVAL: float = 0.05  # В секундах
+    CACHE_EARLY_REFRESH_BETA: float = 1.0  # Больше 1 - обновлять раньше, меньше 1 - позже
+    LOCAL_CACHE_TTL: float = 5.0  # Время жизни поста в локальном кэше воркера, в секундах
+    LOCAL_CACHE_MAX_ITEMS: int = 1000
+    LOCAL_CACHE_MAX_BYTES: int = 16 * 1024 * 1024
+    CACHE_COMPRESS_MIN_BYTES: int = 512  # Описания постов длиннее этого сжимаются в кэше
+    CACHE_COMPRESS_LEVEL: int = 6
+
+    REACTIONS_FLUSH_BATCH_SIZE: int = 1000
+    REACTIONS_FLUSH_MAX_BATCHES: int = 50  # Сколько пачек максимум переносится за один запуск
+    REACTIONS_FLUSH_LOCK_TIMEOUT: int = 60
+
+    # Восстановление кэша после недоступности редиса
+    CACHE_PREWARM_TOP_N: int = 1000  # Сколько самых читаемых постов прогревается после восстановления
+    CACHE_PREWARM_BATCH_SIZE: int = 100
+    POSTS_READS_MAX_ITEMS: int = 10000  # Сколько постов хранится в рейтинге читаемости
+    POSTS_READS_FLUSH_INTERVAL: float = 5.0  # Как часто воркер апи переносит накопленные чтения в редис, в секундах
+    POSTS_READS_DECAY: float = 0.5  # Во сколько раз уменьшается рейтинг читаемости при каждом запуске decay_posts_reads
+
+    # Запуск апи через gunicorn
+    WEB_WORKERS: int = 0  # 0 - по количеству ядер
+    WEB_BIND: str = '0.0.0.0:8000'
+    WEB_GRACEFUL_TIMEOUT: int = 30  # Сколько секунд после SIGTERM дается на завершение текущих запросов
+    WEB_TIMEOUT: int = 60
+    WEB_KEEPALIVE: int = 5
+    SHUTDOWN_DRAIN_TIMEOUT: float = 5.0  # Сколько секунд ждать фоновые записи в кэш при остановке воркера
+    HEALTH_CHECK_TIMEOUT: float = 1.0
+
+    WORKER_METRICS_PORT: int = 9808  # Порт, на котором celery воркер отдает метрики prometheus
 
     CELERY_BROKER_URL: str = "redis://redis-celery:6379/1"
     CELERY_RESULT_BACKEND: str = "redis://redis-celery:6379/1"
     CELERY_BEAT_SCHEDULE: dict = {
         "update_db": {
             "task": "update_db",
-            "schedule": 86400.0,  # Указано в секундах (1 день)
+            "schedule": 5.0,  # Указано в секундах, как часто журнал лайков переносится в бд
+        },
+        "update_redis": {
+            "task": "update_redis",
+            "schedule": 30.0,  # Как часто проверяется, нужно ли восстановить кэш после падения редиса
+        },
+        "decay_posts_reads": {
+            "task": "decay_posts_reads",
+            "schedule": 600.0,  # Как часто рейтинг читаемости постов уменьшается и обрезается
+        },
+        "verify_pending_users": {
+            "task": "verify_pending_users",
+            "schedule": 10.0,  # Подбирает аккаунты в статусе pending, если таска не поставилась при регистрации
         },
     }
 
+    def check_external_api_keys(self) -> None:
+        """Проверяет ключи hunter/clearbit при запуске апи или celery воркера"""
+        missing = [name for name in ('HUNTER_API_KEY', 'CLEARBIT_API_KEY') if not getattr(self, name)]
+        if missing:
+            raise RuntimeError(f'Missing required settings: {", ".join(missing)}')
+
 
 settings = AppSettings()
 
 
+ASYNC_CLIENTS = ('redis', 'binary_redis', 'pubsub_redis')
+
+
 class ConnectionManager:
-    redis = redis.Redis(host='redis-cache', port=6380, charset="utf-8", decode_responses=True, db=0)
+    # Асинхронный клиент для запросов к апи (с короткими таймаутами и предохранителем), отдельный клиент без
+    # таймаута чтения для долгой подписки на канал инвалидации, синхронный для celery тасок.
+    # Бинарные клиенты (без декодирования ответов) читают и пишут упакованные посты.
+    # Клиенты создаются при первом обращении, поэтому процесс создает только те, которыми пользуется
+    redis_breaker = CircuitBreaker(name='redis-cache', failure_threshold=settings.REDIS_BREAKER_FAILURE_THRESHOLD,
+                                   recovery_timeout=settings.REDIS_BREAKER_RECOVERY_TIMEOUT)
+
+    @cached_property
+    def redis(self) -> BreakerRedis:
+        return BreakerRedis(host='redis-cache', port=6380, encoding="utf-8", decode_responses=True, db=0,
+                            socket_timeout=settings.REDIS_SOCKET_TIMEOUT,
+                            socket_connect_timeout=settings.REDIS_CONNECT_TIMEOUT, breaker=self.redis_breaker)
+
+    @cached_property
+    def binary_redis(self) -> BreakerRedis:
+        return BreakerRedis(host='redis-cache', port=6380, db=0, socket_timeout=settings.REDIS_SOCKET_TIMEOUT,
+                            socket_connect_timeout=settings.REDIS_CONNECT_TIMEOUT, breaker=self.redis_breaker)
+
+    @cached_property
+    def pubsub_redis(self) -> AsyncRedis:
+        return AsyncRedis(host='redis-cache', port=6380, encoding="utf-8", decode_responses=True, db=0,
+                          socket_connect_timeout=settings.REDIS_CONNECT_TIMEOUT)
+
+    @cached_property
+    def sync_redis(self) -> Redis:
+        return Redis(host='redis-cache', port=6380, charset="utf-8", decode_responses=True, db=0)
+
+    @cached_property
+    def sync_binary_redis(self) -> Redis:
+        return Redis(host='redis-cache', port=6380, db=0)
+
+    def reset_after_fork(self) -> None:
+        """Сбрасывает соединения асинхронных клиентов, унаследованные от родительского процесса.
+        Синхронный клиент redis-py делает это сам по смене pid"""
+        for name in ASYNC_CLIENTS:
+            if name in self.__dict__:
+                self.__dict__[name].connection_pool.reset()
+
+    async def close(self) -> None:
+        """Закрывает пулы уже созданных асинхронных клиентов"""
+        for name in ASYNC_CLIENTS:
+            if name in self.__dict__:
+                await self.__dict__[name].close()
 
 
 manager = ConnectionManager()
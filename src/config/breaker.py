@@ -0,0 +1,141 @@
+import asyncio
+import logging
+import time
+
+from redis.asyncio import Redis as AsyncRedis
+from redis.asyncio.client import Pipeline
+from redis.exceptions import ConnectionError, RedisError, TimeoutError
+
+from config.metrics import (CIRCUIT_BREAKER_STATE, CIRCUIT_BREAKER_TRANSITIONS, CIRCUIT_BREAKER_REJECTED,
+                            REDIS_COMMAND_DURATION)
+
+logger = logging.getLogger('app.config.breaker')
+
+CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+# Ошибки, которые говорят о недоступности редиса. Ошибки команд (ResponseError и т.п.) значат, что редис отвечает
+FAILURE_ERRORS = (ConnectionError, TimeoutError, OSError, asyncio.TimeoutError)
+
+
+class CircuitOpenError(ConnectionError):
+    """Запрос к редису не отправлялся, потому что цепь разомкнута"""
+
+
+class CircuitBreaker:
+    """Предохранитель перед внешним сервисом. В закрытом состоянии пропускает все запросы и считает ошибки подряд.
+    После failure_threshold ошибок размыкается и recovery_timeout секунд сразу отказывает. Затем переходит
+    в полуоткрытое состояние и пропускает один пробный запрос: если он прошел, то цепь замыкается, иначе снова
+    размыкается. Рассчитан на использование из одного event loop"""
+
+    def __init__(self, name: str, failure_threshold: int, recovery_timeout: float) -> None:
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.state = CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trial_in_flight = False
+        CIRCUIT_BREAKER_STATE.labels(self.name).set(STATE_VALUES[CLOSED])
+
+    def allow_request(self) -> bool:
+        """Можно ли отправить запрос. В полуоткрытом состоянии разрешает только один запрос за раз"""
+        if self.state == OPEN and time.monotonic() - self._opened_at >= self.recovery_timeout:
+            self._transition(HALF_OPEN)
+        if self.state == CLOSED:
+            return True
+        if self.state == HALF_OPEN and not self._trial_in_flight:
+            self._trial_in_flight = True
+            return True
+        CIRCUIT_BREAKER_REJECTED.labels(self.name).inc()
+        return False
+
+    def record_success(self) -> None:
+        self._failures = 0
+        self._trial_in_flight = False
+        if self.state != CLOSED:
+            self._transition(CLOSED)
+
+    def record_failure(self) -> None:
+        self._failures += 1
+        self._trial_in_flight = False
+        if self.state == HALF_OPEN or self._failures >= self.failure_threshold:
+            self._opened_at = time.monotonic()
+            if self.state != OPEN:
+                self._transition(OPEN)
+
+    def release(self) -> None:
+        """Снимает пометку пробного запроса, если он завершился без ответа (например был отменен)"""
+        self._trial_in_flight = False
+
+    async def call(self, func, *args, **kwargs):
+        """Выполняет запрос через предохранитель. Если цепь разомкнута, то сразу бросает CircuitOpenError"""
+        if not self.allow_request():
+            raise CircuitOpenError(f'Circuit breaker {self.name} is open')
+        try:
+            result = await func(*args, **kwargs)
+        except FAILURE_ERRORS:
+            self.record_failure()
+            raise
+        except RedisError:
+            self.record_success()
+            raise
+        except BaseException:
+            self.release()
+            raise
+        self.record_success()
+        return result
+
+    def _transition(self, state: str) -> None:
+        logger.warning(f'Circuit breaker {self.name}: {self.state} -> {state}')
+        self.state = state
+        CIRCUIT_BREAKER_STATE.labels(self.name).set(STATE_VALUES[state])
+        CIRCUIT_BREAKER_TRANSITIONS.labels(self.name, state).inc()
+
+
+async def _timed(command: str, func, *args, **kwargs):
+    """Замеряет время команды редиса. Отклоненные предохранителем запросы сюда не попадают"""
+    started = time.perf_counter()
+    try:
+        return await func(*args, **kwargs)
+    finally:
+        REDIS_COMMAND_DURATION.labels(command).observe(time.perf_counter() - started)
+
+
+class BreakerPipeline(Pipeline):
+    breaker: CircuitBreaker
+
+    async def execute(self, raise_on_error: bool = True):
+        if not self.command_stack and not self.watching:
+            return []
+        return await self.breaker.call(_timed, 'PIPELINE', super().execute, raise_on_error=raise_on_error)
+
+
+class BreakerRedis(AsyncRedis):
+    """Асинхронный клиент редиса, все команды и пайплайны которого идут через предохранитель"""
+
+    def __init__(self, *args, breaker: CircuitBreaker, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.breaker = breaker
+
+    async def execute_command(self, *args, **options):
+        return await self.breaker.call(_timed, str(args[0]).upper(), super().execute_command, *args, **options)
+
+    def pipeline(self, transaction: bool = True, shard_hint: str | None = None) -> BreakerPipeline:
+        pipe = BreakerPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+        pipe.breaker = self.breaker
+        return pipe
+
+
+async def probe_health(client: BreakerRedis, interval: float) -> None:
+    """Фоновая проверка редиса: пока цепь не замкнута, пингует его пробным запросом,
+    чтобы после восстановления цепь замкнулась без участия пользовательских запросов"""
+    while True:
+        await asyncio.sleep(interval)
+        if client.breaker.state == CLOSED:
+            continue
+        try:
+            await client.ping()
+        except CircuitOpenError:
+            pass
+        except FAILURE_ERRORS as err:
+            logger.debug(err)
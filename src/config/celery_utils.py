@@ -1,9 +1,70 @@
+import logging
+import os
+import time
+
 from celery import current_app as current_celery_app
+from celery.signals import task_prerun, task_postrun, worker_ready, worker_process_shutdown
+from prometheus_client import multiprocess, start_http_server
+from prometheus_client.core import GaugeMetricFamily
+from redis import Redis
+from redis.exceptions import RedisError
 
 from config.base import settings
+from config.metrics import CELERY_TASK_DURATION, metrics_registry
+
+logger = logging.getLogger('app.config.celery_utils')
+
+_tasks_started: dict[str, float] = {}
 
 
 def create_celery():
     celery_app = current_celery_app
     celery_app.config_from_object(settings, namespace="CELERY")
     return celery_app
+
+
+class CeleryQueueCollector:
+    """Длина очередей celery в брокере, считается в момент сбора метрик"""
+
+    def __init__(self, broker_url: str, queues: list[str]) -> None:
+        self.client = Redis.from_url(broker_url, socket_timeout=1, socket_connect_timeout=1)
+        self.queues = queues
+
+    def collect(self):
+        metric = GaugeMetricFamily('celery_queue_length', 'Количество задач в очереди celery', labels=['queue'])
+        try:
+            for queue in self.queues:
+                metric.add_metric([queue], self.client.llen(queue))
+        except RedisError as err:
+            logger.error(err)
+        yield metric
+
+
+@task_prerun.connect
+def _start_task_timer(task_id: str, **kwargs) -> None:
+    _tasks_started[task_id] = time.perf_counter()
+
+
+@task_postrun.connect
+def _observe_task_duration(task_id: str, task, state: str | None = None, **kwargs) -> None:
+    started = _tasks_started.pop(task_id, None)
+    if started is not None:
+        CELERY_TASK_DURATION.labels(task.name, state or 'UNKNOWN').observe(time.perf_counter() - started)
+
+
+@worker_ready.connect
+def _start_metrics_server(sender, **kwargs) -> None:
+    """Поднимает http сервер с метриками в главном процессе воркера. Таски выполняются в дочерних процессах,
+    поэтому их метрики видны только при заданном PROMETHEUS_MULTIPROC_DIR"""
+    registry = metrics_registry()
+    if settings.CELERY_BROKER_URL.startswith('redis'):
+        registry.register(CeleryQueueCollector(settings.CELERY_BROKER_URL,
+                                               queues=[sender.app.conf.task_default_queue]))
+    start_http_server(settings.WORKER_METRICS_PORT, registry=registry)
+
+
+@worker_process_shutdown.connect
+def _mark_process_dead(pid: int, **kwargs) -> None:
+    """Убирает gauge метрики завершившегося дочернего процесса"""
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        multiprocess.mark_process_dead(pid)
@@ -1,31 +1,144 @@
-from sqlalchemy import create_engine
-from sqlalchemy.engine import Engine
+import time
+
+from sqlalchemy import create_engine, String
+from sqlalchemy.dialects.sqlite.aiosqlite import AsyncAdapt_aiosqlite_connection
+from sqlalchemy.engine import Engine, make_url
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.ext.compiler import compiles
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, scoped_session
+from sqlalchemy.pool import QueuePool, AsyncAdaptedQueuePool
+from sqlalchemy.sql.functions import FunctionElement
 from sqlalchemy import event
 from sqlite3 import Connection as SQLite3Connection
 
-SQLALCHEMY_DATABASE_URL = "sqlite:///./social.db"
+from config.base import settings
+from config.metrics import DB_POOL_CHECKOUT_WAIT, DB_POOL_CHECKED_OUT, DB_POOL_SATURATION, DB_STATEMENT_DURATION
+
+ASYNC_DRIVERS = {'sqlite': 'sqlite+aiosqlite', 'postgresql': 'postgresql+asyncpg'}
+SYNC_DRIVERS = {'sqlite': 'sqlite', 'postgresql': 'postgresql+psycopg2'}
+
+
+def build_database_url(url: str, drivers: dict) -> str:
+    """Подставляет в DATABASE_URL драйвер нужный синхронному или асинхронному движку"""
+    url = make_url(url.replace('postgres://', 'postgresql://', 1))
+    return str(url.set(drivername=drivers.get(url.get_backend_name(), url.drivername)))
+
+
+class _PoolMetricsMixin:
+    """Замеряет время ожидания соединения в пуле"""
+    engine_label = ''
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            DB_POOL_CHECKOUT_WAIT.labels(self.engine_label).observe(time.perf_counter() - started)
+
+
+class InstrumentedQueuePool(_PoolMetricsMixin, QueuePool):
+    engine_label = 'sync'
+
+
+class InstrumentedAsyncQueuePool(_PoolMetricsMixin, AsyncAdaptedQueuePool):
+    engine_label = 'async'
+
+
+def _track_pool_usage(engine: Engine, label: str) -> None:
+    """Обновляет метрики занятости пула на выдаче и возврате соединений. Емкость пула берется из тех же
+    настроек, с которыми он создан в _engine_options"""
+    pool = engine.pool
+    if not isinstance(pool, QueuePool):
+        return
+    capacity = pool.size() + max(settings.DB_MAX_OVERFLOW, 0)
+
+    def update(*args) -> None:
+        checked_out = pool.checkedout()
+        DB_POOL_CHECKED_OUT.labels(label).set(checked_out)
+        DB_POOL_SATURATION.labels(label).set(checked_out / capacity)
+
+    event.listen(pool, 'checkout', update)
+    event.listen(pool, 'checkin', update)
+
 
-engine = create_engine(
-    SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False})
+def _engine_options(url: str, poolclass) -> dict:
+    """Параметры пула. У sqlite пул не настраивается, там свой NullPool/StaticPool"""
+    if make_url(url).get_backend_name() == 'sqlite':
+        return {'connect_args': {'check_same_thread': False}}
+    return {'poolclass': poolclass,
+            'pool_size': settings.DB_POOL_SIZE,
+            'max_overflow': settings.DB_MAX_OVERFLOW,
+            'pool_timeout': settings.DB_POOL_TIMEOUT,
+            'pool_recycle': settings.DB_POOL_RECYCLE,
+            'pool_pre_ping': settings.DB_POOL_PRE_PING}
+
+
+SQLALCHEMY_DATABASE_URL = build_database_url(settings.DATABASE_URL, SYNC_DRIVERS)
+ASYNC_SQLALCHEMY_DATABASE_URL = build_database_url(settings.DATABASE_URL, ASYNC_DRIVERS)
+
+# Синхронный движок используется celery воркером и для создания таблиц
+engine = create_engine(SQLALCHEMY_DATABASE_URL, **_engine_options(SQLALCHEMY_DATABASE_URL, InstrumentedQueuePool))
+_track_pool_usage(engine, 'sync')
 
 SessionLocal = scoped_session(sessionmaker(autocommit=False, autoflush=False, bind=engine))
 
+# Асинхронный движок обслуживает запросы к апи
+async_engine = create_async_engine(ASYNC_SQLALCHEMY_DATABASE_URL,
+                                   **_engine_options(ASYNC_SQLALCHEMY_DATABASE_URL, InstrumentedAsyncQueuePool))
+_track_pool_usage(async_engine.sync_engine, 'async')
+
+AsyncSessionLocal = sessionmaker(async_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
+
 Base = declarative_base()
 
 
 @event.listens_for(Engine, "connect")
 def _set_sqlite_pragma(dbapi_connection, connection_record):
-    if isinstance(dbapi_connection, SQLite3Connection):
+    """WAL позволяет читать параллельно с записью, synchronous=NORMAL в режиме WAL безопасен и убирает fsync
+    на каждый коммит, busy_timeout заставляет ждать блокировку вместо мгновенной ошибки database is locked"""
+    if isinstance(dbapi_connection, (SQLite3Connection, AsyncAdapt_aiosqlite_connection)):
         cursor = dbapi_connection.cursor()
         cursor.execute("PRAGMA foreign_keys=ON;")
+        cursor.execute("PRAGMA journal_mode=WAL;")
+        cursor.execute("PRAGMA synchronous=NORMAL;")
+        cursor.execute(f"PRAGMA busy_timeout={int(settings.SQLITE_BUSY_TIMEOUT)};")
         cursor.close()
 
 
-def get_db():
-    db = SessionLocal()
-    try:
+@event.listens_for(Engine, "before_cursor_execute")
+def _start_statement_timer(conn, cursor, statement, parameters, context, executemany):
+    context._started = time.perf_counter()
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _observe_statement_duration(conn, cursor, statement, parameters, context, executemany):
+    """Время sql запроса по движку и типу запроса (SELECT, INSERT, UPDATE...)"""
+    started = getattr(context, '_started', None)
+    if started is None:
+        return
+    label = 'async' if conn.engine is async_engine.sync_engine else 'sync'
+    operation = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else 'UNKNOWN'
+    DB_STATEMENT_DURATION.labels(label, operation).observe(time.perf_counter() - started)
+
+
+class group_concat_ids(FunctionElement):
+    """Склеивает айдишники группы в строку через ':'"""
+    type = String()
+    name = 'group_concat_ids'
+    inherit_cache = True
+
+
+@compiles(group_concat_ids)
+def _group_concat_ids(element, compiler, **kw):
+    return "group_concat(%s, ':')" % compiler.process(element.clauses, **kw)
+
+
+@compiles(group_concat_ids, 'postgresql')
+def _group_concat_ids_postgresql(element, compiler, **kw):
+    return "string_agg(CAST(%s AS TEXT), ':')" % compiler.process(element.clauses, **kw)
+
+
+async def get_db():
+    async with AsyncSessionLocal() as db:
         yield db
-    finally:
-        db.close()
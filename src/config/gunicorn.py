@@ -0,0 +1,34 @@
+"""Настройки gunicorn для продакшена: python -m gunicorn main:app -c config/gunicorn.py"""
+import multiprocessing
+import os
+
+from prometheus_client import multiprocess
+
+from config.base import manager, settings
+
+bind = settings.WEB_BIND
+# Воркеры асинхронные, а bcrypt считается в отдельном пуле процессов, поэтому одного воркера на ядро достаточно
+workers = settings.WEB_WORKERS or multiprocessing.cpu_count()
+worker_class = 'uvicorn.workers.UvicornWorker'
+# Приложение импортируется один раз в мастере. Это безопасно: соединения с бд и редисом при импорте
+# не открываются, а пулы, созданные до форка, сбрасываются в post_fork
+preload_app = True
+graceful_timeout = settings.WEB_GRACEFUL_TIMEOUT
+timeout = settings.WEB_TIMEOUT
+keepalive = settings.WEB_KEEPALIVE
+accesslog = '-'
+
+
+def post_fork(server, worker) -> None:
+    """Каждый воркер открывает свои соединения, а не использует унаследованные от мастера"""
+    from config.db import engine, async_engine
+
+    engine.dispose(close=False)
+    async_engine.sync_engine.dispose(close=False)
+    manager.reset_after_fork()
+
+
+def child_exit(server, worker) -> None:
+    """Убирает gauge метрики завершившегося воркера"""
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        multiprocess.mark_process_dead(worker.pid)
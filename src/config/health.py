@@ -0,0 +1,51 @@
+import asyncio
+import logging
+
+from fastapi import APIRouter, status
+from redis.exceptions import RedisError
+from sqlalchemy import text
+from sqlalchemy.exc import SQLAlchemyError
+from starlette.responses import JSONResponse
+
+from config.base import manager, settings
+from config.db import async_engine
+
+logger = logging.getLogger('app.config.health')
+
+health_router = APIRouter()
+
+
+async def check_db() -> bool:
+    try:
+        async with async_engine.connect() as connection:
+            await asyncio.wait_for(connection.execute(text('SELECT 1')), timeout=settings.HEALTH_CHECK_TIMEOUT)
+        return True
+    except (SQLAlchemyError, OSError, asyncio.TimeoutError) as err:
+        logger.error(err)
+        return False
+
+
+async def check_redis() -> bool:
+    try:
+        return await asyncio.wait_for(manager.redis.ping(), timeout=settings.HEALTH_CHECK_TIMEOUT)
+    except (RedisError, asyncio.TimeoutError) as err:
+        logger.error(err)
+        return False
+
+
+@health_router.get('/live')
+async def live() -> dict:
+    """Процесс жив и обслуживает event loop, зависимости не проверяются"""
+    return {'status': 'ok'}
+
+
+@health_router.get('/ready')
+async def ready() -> JSONResponse:
+    """Готовность принимать трафик. Без бд воркер не работает и вернет код 503. Без редиса апи отвечает
+    из бд, поэтому недоступный редис отмечается как degraded, но воркер не выводится из балансировки"""
+    db_ok, redis_ok = await asyncio.gather(check_db(), check_redis())
+    checks = {'db': 'ok' if db_ok else 'error', 'redis': 'ok' if redis_ok else 'error'}
+    if not db_ok:
+        return JSONResponse(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, content={'status': 'error', **checks})
+    return JSONResponse(status_code=status.HTTP_200_OK,
+                        content={'status': 'ok' if redis_ok else 'degraded', **checks})
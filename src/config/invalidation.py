@@ -0,0 +1,53 @@
+import asyncio
+import logging
+from typing import Callable, Hashable
+
+from redis.exceptions import RedisError
+
+from config.base import manager
+from config.lru import LRUCache
+
+logger = logging.getLogger('app.config.invalidation')
+
+# Каналы инвалидации локальных кэшей воркеров: канал -> (кэш, функция, переводящая сообщение в ключ кэша)
+_channels: dict[str, tuple[LRUCache, Callable[[str], Hashable]]] = {}
+_listener_task: asyncio.Task | None = None
+
+
+def register_invalidation_channel(channel: str, cache: LRUCache, key: Callable[[str], Hashable] = str) -> None:
+    """Подписывает локальный кэш на канал: ключи из сообщений канала будут сбрасываться из кэша"""
+    _channels[channel] = (cache, key)
+
+
+async def listen_for_invalidations() -> None:
+    """Слушает каналы инвалидации и сбрасывает измененные записи из локальных кэшей. Пока подписка
+    не активна, сообщения могут теряться, поэтому при каждом переподключении локальные кэши очищаются"""
+    while True:
+        pubsub = manager.pubsub_redis.pubsub(ignore_subscribe_messages=True)
+        try:
+            await pubsub.subscribe(*_channels)
+            _clear_caches()
+            async for message in pubsub.listen():
+                cache, key = _channels[message['channel']]
+                cache.invalidate(key(message['data']))
+        except (RedisError, OSError) as err:
+            logger.error(err)
+            _clear_caches()
+            await asyncio.sleep(1)
+        finally:
+            await pubsub.close()
+
+
+def _clear_caches() -> None:
+    for cache, _ in _channels.values():
+        cache.clear()
+
+
+async def start_invalidation_listener() -> None:
+    global _listener_task
+    _listener_task = asyncio.create_task(listen_for_invalidations())
+
+
+async def stop_invalidation_listener() -> None:
+    if _listener_task is not None:
+        _listener_task.cancel()
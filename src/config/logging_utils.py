@@ -0,0 +1,12 @@
+import json
+import logging.config
+
+from config.base import settings
+
+LOGGING_CONFIG_FILE = settings.BASE_DIR / 'logging_config.json'
+
+
+def configure_logging() -> None:
+    """Настраивает логгеры из logging_config.json, общего для апи и celery воркера"""
+    with open(LOGGING_CONFIG_FILE) as config_file:
+        logging.config.dictConfig(json.load(config_file))
@@ -0,0 +1,77 @@
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Hashable
+
+from config.metrics import (LOCAL_CACHE_HITS, LOCAL_CACHE_MISSES, LOCAL_CACHE_EVICTIONS, LOCAL_CACHE_INVALIDATIONS,
+                            LOCAL_CACHE_ITEMS, LOCAL_CACHE_BYTES)
+
+
+def approximate_size(value: Any) -> int:
+    """Примерный размер значения в байтах: длина строкового представления ключей и значений"""
+    if isinstance(value, dict):
+        return sum(len(str(key)) + len(str(item)) for key, item in value.items())
+    return len(str(value))
+
+
+class LRUCache:
+    """Локальный кэш воркера, ограниченный количеством записей и суммарным размером, с TTL на каждую запись.
+    Не потокобезопасен, рассчитан на использование из одного event loop"""
+
+    def __init__(self, name: str, max_items: int, max_bytes: int, ttl: float,
+                 sizeof: Callable[[Any], int] = approximate_size) -> None:
+        self.name = name
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.sizeof = sizeof
+        self._data: OrderedDict[Hashable, tuple[float, int, Any]] = OrderedDict()
+        self._bytes = 0
+
+    def get(self, key: Hashable) -> Any | None:
+        """Возвращает значение и помечает его как недавно использованное. Просроченные записи удаляются"""
+        item = self._data.get(key)
+        if item is None or item[0] < time.monotonic():
+            if item is not None:
+                self._pop(key)
+            LOCAL_CACHE_MISSES.labels(self.name).inc()
+            return None
+        self._data.move_to_end(key)
+        LOCAL_CACHE_HITS.labels(self.name).inc()
+        return item[2]
+
+    def set(self, key: Hashable, value: Any) -> None:
+        """Кладет значение в кэш, при переполнении вытесняет давно неиспользуемые записи"""
+        size = self.sizeof(value)
+        if size > self.max_bytes:
+            return
+        self._pop(key)
+        self._data[key] = (time.monotonic() + self.ttl, size, value)
+        self._bytes += size
+        while len(self._data) > self.max_items or self._bytes > self.max_bytes:
+            self._pop(next(iter(self._data)))
+            LOCAL_CACHE_EVICTIONS.labels(self.name).inc()
+        self._update_gauges()
+
+    def invalidate(self, key: Hashable) -> None:
+        if self._pop(key):
+            LOCAL_CACHE_INVALIDATIONS.labels(self.name).inc()
+            self._update_gauges()
+
+    def clear(self) -> None:
+        self._data.clear()
+        self._bytes = 0
+        self._update_gauges()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def _pop(self, key: Hashable) -> bool:
+        item = self._data.pop(key, None)
+        if item is None:
+            return False
+        self._bytes -= item[1]
+        return True
+
+    def _update_gauges(self) -> None:
+        LOCAL_CACHE_ITEMS.labels(self.name).set(len(self._data))
+        LOCAL_CACHE_BYTES.labels(self.name).set(self._bytes)
@@ -0,0 +1,60 @@
+import os
+
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram, REGISTRY, multiprocess
+
+# Границы корзин для быстрых операций: запросов к редису, бд и эндпоинтов апи
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+DB_POOL_CHECKOUT_WAIT = Histogram(
+    'db_pool_checkout_wait_seconds', 'Время ожидания свободного соединения в пуле бд', ['engine'],
+    buckets=LATENCY_BUCKETS + (30,),
+)
+DB_POOL_CHECKED_OUT = Gauge('db_pool_checked_out', 'Количество выданных из пула соединений', ['engine'],
+                            multiprocess_mode='livesum')
+DB_POOL_SATURATION = Gauge('db_pool_saturation_ratio', 'Доля занятых соединений от емкости пула (size + overflow)',
+                           ['engine'], multiprocess_mode='livemax')
+
+LOCAL_CACHE_HITS = Counter('local_cache_hits_total', 'Попадания в локальный (in-process) кэш', ['cache'])
+LOCAL_CACHE_MISSES = Counter('local_cache_misses_total', 'Промахи локального (in-process) кэша', ['cache'])
+LOCAL_CACHE_EVICTIONS = Counter('local_cache_evictions_total', 'Вытеснения из локального кэша по размеру', ['cache'])
+LOCAL_CACHE_INVALIDATIONS = Counter('local_cache_invalidations_total', 'Инвалидации записей локального кэша',
+                                    ['cache'])
+LOCAL_CACHE_ITEMS = Gauge('local_cache_items', 'Количество записей в локальном кэше', ['cache'],
+                          multiprocess_mode='livesum')
+LOCAL_CACHE_BYTES = Gauge('local_cache_bytes', 'Примерный объем данных в локальном кэше', ['cache'],
+                          multiprocess_mode='livesum')
+
+CIRCUIT_BREAKER_STATE = Gauge('circuit_breaker_state',
+                              'Состояние предохранителя: 0 - замкнут, 1 - полуоткрыт, 2 - разомкнут',
+                              ['breaker'], multiprocess_mode='livemax')
+CIRCUIT_BREAKER_TRANSITIONS = Counter('circuit_breaker_transitions_total', 'Переходы предохранителя в состояние',
+                                      ['breaker', 'state'])
+CIRCUIT_BREAKER_REJECTED = Counter('circuit_breaker_rejected_total', 'Запросы, отклоненные разомкнутым предохранителем',
+                                   ['breaker'])
+
+HTTP_REQUEST_DURATION = Histogram('http_request_duration_seconds', 'Время обработки запроса к апи',
+                                  ['method', 'route', 'status'], buckets=LATENCY_BUCKETS)
+DB_STATEMENT_DURATION = Histogram('db_statement_duration_seconds', 'Время выполнения sql запроса',
+                                  ['engine', 'operation'], buckets=LATENCY_BUCKETS)
+REDIS_COMMAND_DURATION = Histogram('redis_command_duration_seconds', 'Время выполнения команды или пайплайна редиса',
+                                   ['command'], buckets=LATENCY_BUCKETS)
+PASSWORD_HASHING_DURATION = Histogram('password_hashing_duration_seconds',
+                                      'Время bcrypt вместе с ожиданием в пуле процессов', ['operation'],
+                                      buckets=LATENCY_BUCKETS)
+
+POSTS_CACHE_LOOKUPS = Counter('posts_cache_lookups_total', 'Поиск постов в редисе: hit или miss', ['result'])
+CACHE_FALLBACKS = Counter('cache_fallbacks_total', 'Операции, выполненные через бд из-за недоступности редиса',
+                          ['operation'])
+
+CELERY_TASK_DURATION = Histogram('celery_task_duration_seconds', 'Время выполнения задачи celery', ['task', 'state'],
+                                 buckets=LATENCY_BUCKETS + (30, 60, 300))
+
+
+def metrics_registry() -> CollectorRegistry:
+    """Реестр для отдачи метрик. Если задан PROMETHEUS_MULTIPROC_DIR (несколько процессов воркера),
+    то метрики собираются из файлов всех процессов"""
+    if 'PROMETHEUS_MULTIPROC_DIR' not in os.environ:
+        return REGISTRY
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return registry
@@ -1,9 +1,104 @@
-from fastapi import FastAPI
+import asyncio
+import time
+from contextlib import asynccontextmanager
 
-from config.celery_utils import create_celery
+from fastapi import FastAPI, Response
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from config.base import manager, settings
+from config.breaker import probe_health
+from config.db import async_engine
+from config.logging_utils import configure_logging
+from config.metrics import HTTP_REQUEST_DURATION, metrics_registry
+
+
+class RequestMetricsMiddleware:
+    """Замеряет время обработки запросов по шаблону пути роута (/api/posts/{post_id}), а не по самому пути,
+    чтобы количество серий не росло вместе с количеством постов. Запросы мимо роутов попадают в unmatched"""
+
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+        self._routes: dict | None = None
+
+    def _route_path(self, scope: Scope) -> str:
+        # Роутер кладет в scope найденный эндпоинт, шаблон пути берется по нему из роутов приложения
+        if self._routes is None:
+            self._routes = {getattr(route, 'endpoint', getattr(route, 'app', None)): route.path
+                            for route in scope['app'].routes}
+        return self._routes.get(scope.get('endpoint'), 'unmatched')
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        status_code = 500
+        started = time.perf_counter()
+
+        async def send_wrapper(message: Message) -> None:
+            nonlocal status_code
+            if message['type'] == 'http.response.start':
+                status_code = message['status']
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            HTTP_REQUEST_DURATION.labels(scope['method'], self._route_path(scope),
+                                         status_code).observe(time.perf_counter() - started)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Ресурсы воркера апи. Соединения с бд, редисом и внешними апи открываются при первом запросе,
+    здесь запускаются фоновые задачи, а при остановке все закрывается"""
+    from config.invalidation import start_invalidation_listener, stop_invalidation_listener
+    from posts.cache import drain_background_refreshes, flush_post_reads, flush_post_reads_periodically
+    from users.passwords import shutdown_password_hashing
+    from users.validators import close_http_session
+
+    settings.check_external_api_keys()
+    redis_probe = asyncio.create_task(
+        probe_health(client=manager.redis, interval=settings.REDIS_HEALTH_PROBE_INTERVAL))
+    reads_flusher = asyncio.create_task(
+        flush_post_reads_periodically(interval=settings.POSTS_READS_FLUSH_INTERVAL))
+    await start_invalidation_listener()
+    try:
+        yield
+    finally:
+        # К этому моменту сервер уже дождался текущих запросов, осталось дописать фоновые обновления кэша
+        await drain_background_refreshes(timeout=settings.SHUTDOWN_DRAIN_TIMEOUT)
+        reads_flusher.cancel()
+        await flush_post_reads()
+        redis_probe.cancel()
+        await stop_invalidation_listener()
+        await shutdown_password_hashing()
+        await close_http_session()
+        await async_engine.dispose()
+        await manager.close()
 
 
 def create_app() -> FastAPI:
+    """Собирает приложение апи. Роутеры импортируются здесь, чтобы импорт config.server не тянул весь код апи,
+    таблицы бд создаются отдельно командой python manage.py migrate"""
+    from config.health import health_router
+    from posts.router import post_router
+    from users.router import user_router
+
+    configure_logging()
     app = FastAPI()
-    app.celery_app = create_celery()
+    # FastAPI этой версии не принимает lifespan в конструкторе, поэтому он передается роутеру напрямую
+    app.router.lifespan_context = lifespan
+    # Обычный роут, а не mount: смонтированное приложение отвечает на /metrics редиректом на /metrics/
+    registry = metrics_registry()
+
+    @app.get('/metrics', include_in_schema=False)
+    def metrics() -> Response:
+        return Response(generate_latest(registry), headers={'Content-Type': CONTENT_TYPE_LATEST})
+
+    app.add_middleware(RequestMetricsMiddleware)
+    app.include_router(health_router, tags=['health'], prefix='/health')
+    app.include_router(user_router, tags=['users'], prefix='/api/users')
+    app.include_router(post_router, tags=['posts'], prefix='/api/posts')
     return app
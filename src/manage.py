@@ -0,0 +1,102 @@
+import click
+from sqlalchemy import inspect, text, func, select, delete
+
+from config.db import Base, engine, SessionLocal
+from posts.export import iter_posts_export
+from posts.models import Post, Likes, Dislikes
+from posts.services import recount_reactions_counters
+from users.models import User, USER_STATUS_ACTIVE
+
+
+# Уникальные индексы (post_id, user) таблиц реакций, создаются только после удаления дублей
+REACTION_UNIQUE_INDEXES = {index for model in (Likes, Dislikes) for index in model.__table__.indexes if index.unique}
+
+
+@click.group()
+def cli() -> None:
+    """Служебные команды приложения"""
+
+
+@cli.command('migrate')
+def migrate() -> None:
+    """Создает недостающие таблицы и индексы. Запускается перед стартом апи, само приложение схему не меняет.
+    Колонки, которых нет в уже существующих таблицах, добавляются командами ниже. Уникальные индексы реакций
+    в существующих таблицах здесь не создаются: в старой бд могут быть дубли, их убирает backfill-reaction-counters"""
+    with engine.begin() as connection:
+        Base.metadata.create_all(bind=connection)
+        for table in Base.metadata.sorted_tables:
+            for index in table.indexes:
+                if index not in REACTION_UNIQUE_INDEXES:
+                    index.create(bind=connection, checkfirst=True)
+
+        inspector = inspect(connection)
+        columns = {table: {column['name'] for column in inspector.get_columns(table)}
+                   for table in (Post.__tablename__, User.__tablename__)}
+        indexes = {index['name'] for model in (Likes, Dislikes)
+                   for index in inspector.get_indexes(model.__tablename__)}
+    if 'likes_count' not in columns[Post.__tablename__]:
+        click.echo('Run backfill-reaction-counters to add reaction counters to posts')
+    elif any(index.name not in indexes for index in REACTION_UNIQUE_INDEXES):
+        click.echo('Run backfill-reaction-counters to remove duplicate reactions and add unique indexes')
+    if 'status' not in columns[User.__tablename__]:
+        click.echo('Run add-user-status to add account statuses to users')
+    click.echo('Missing tables and indexes created')
+
+
+@cli.command('backfill-reaction-counters')
+def backfill_reaction_counters() -> None:
+    """Добавляет в существующую бд счетчики лайков/дизлайков у постов и уникальные индексы (post_id, user)
+    у таблиц реакций, затем заполняет счетчики по текущим данным. Команду можно запускать повторно"""
+    with engine.begin() as connection:
+        post_columns = {column['name'] for column in inspect(connection).get_columns(Post.__tablename__)}
+        for column in ('likes_count', 'dislikes_count'):
+            if column not in post_columns:
+                connection.execute(text(f'ALTER TABLE {Post.__tablename__} ADD COLUMN {column} '
+                                        f'INTEGER NOT NULL DEFAULT 0'))
+                click.echo(f'Column posts.{column} added')
+
+        for model in (Likes, Dislikes):
+            duplicates = (select(func.min(model.id))
+                          .group_by(model.post_id, model.user)
+                          .scalar_subquery())
+            removed = connection.execute(delete(model).where(model.id.not_in(duplicates))).rowcount
+            if removed:
+                click.echo(f'{removed} duplicate rows removed from {model.__tablename__}')
+            for index in model.__table__.indexes:
+                index.create(bind=connection, checkfirst=True)
+
+        updated = connection.execute(recount_reactions_counters()).rowcount
+        click.echo(f'Reaction counters recalculated for {updated} posts')
+
+
+@cli.command('add-user-status')
+def add_user_status() -> None:
+    """Добавляет в существующую бд колонку статуса аккаунта. Существующие юзеры получают статус active"""
+    with engine.begin() as connection:
+        user_columns = {column['name'] for column in inspect(connection).get_columns(User.__tablename__)}
+        if 'status' in user_columns:
+            click.echo('Column users.status already exists')
+            return
+        connection.execute(text(f"ALTER TABLE {User.__tablename__} ADD COLUMN status VARCHAR(16) NOT NULL "
+                                f"DEFAULT '{USER_STATUS_ACTIVE}'"))
+        click.echo('Column users.status added')
+
+
+@cli.command('export-posts')
+@click.option('--output', type=click.File('w', encoding='utf-8'), default='-', help='Файл, по умолчанию stdout')
+@click.option('--author', type=int, default=None)
+@click.option('--after-id', type=int, default=None)
+@click.option('--before-id', type=int, default=None)
+@click.option('--reactors', is_flag=True, help='Добавить айди юзеров, поставивших лайк/дизлайк')
+def export_posts(output, author: int | None, after_id: int | None, before_id: int | None, reactors: bool) -> None:
+    """Выгружает посты в формате NDJSON через серверный курсор, память не зависит от размера таблицы"""
+    db = SessionLocal()
+    try:
+        for chunk in iter_posts_export(db, author=author, after_id=after_id, before_id=before_id, reactors=reactors):
+            output.write(chunk)
+    finally:
+        db.close()
+
+
+if __name__ == '__main__':
+    cli()
@@ -1,90 +1,464 @@
+import asyncio
 import datetime
+import json
 import logging
+import math
+import random
+import time
+import uuid
+from collections import Counter
 
 from fastapi import HTTPException
-from redis.exceptions import RedisError, ConnectionError
-from sqlalchemy.orm import Session
+from redis.exceptions import RedisError, ConnectionError, TimeoutError
+from sqlalchemy.ext.asyncio import AsyncSession
 from starlette.responses import JSONResponse
 
 from posts.models import Likes, Dislikes
-from posts.services import fetch_one_post, change_emotions_in_db
+from posts.services import fetch_one_post, fetch_posts_by_ids, change_emotions_in_db, select_posts_authors
+from posts.local_cache import (local_posts_cache, get_local_post, set_local_post,
+                               POSTS_INVALIDATION_CHANNEL)
+from posts.serialization import (post_cache_fields, unpack_hot, unpack_cold, HOT_FIELD, COLD_FIELD,
+                                 LEGACY_FIELDS)
+from posts.utils import (post_key, reactors_key, post_lock_key, apply_pending_reactions, REACTIONS_JOURNAL_KEY,
+                         REACTORS_FIELDS, POSTS_READS_KEY)
 from config.base import settings
+from config.db import AsyncSessionLocal
+from config.metrics import POSTS_CACHE_LOOKUPS, CACHE_FALLBACKS
 from users.schemas import UserInDB
 from config.base import manager
 
 redis = manager.redis
+# Посты в кэше хранятся упакованными, поэтому читаются и пишутся клиентом без декодирования ответов
+binary_redis = manager.binary_redis
 logger = logging.getLogger('app.posts.cache')
 
+REACTORS_TABLES = {'like_user': Likes.__tablename__, 'dislike_user': Dislikes.__tablename__}
+REACTIONS = {'like': ('like_user', Likes), 'dislike': ('dislike_user', Dislikes)}
+OPPOSITE_REACTORS = {'like_user': 'dislike_user', 'dislike_user': 'like_user'}
+
+# KEYS[1] - хэш поста, KEYS[2] - множество реакции, KEYS[3] - множество противоположной реакции,
+# KEYS[4] - журнал изменений для переноса в бд.
+# ARGV[1] - айди юзера, ARGV[2] - ttl множества в секундах, ARGV[3] - айди поста,
+# ARGV[4] - поле реакции, ARGV[5] - поле противоположной реакции, ARGV[6] - канал инвалидации локальных кэшей.
+# Если поста нет в кэше, то вернет nil, иначе количество юзеров в обоих множествах после переключения
+TOGGLE_REACTION_LUA = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return false
+end
+if redis.call('SREM', KEYS[2], ARGV[1]) == 1 then
+    redis.call('XADD', KEYS[4], '*', 'post_id', ARGV[3], 'user', ARGV[1], 'reaction', ARGV[4], 'op', 'remove')
+else
+    redis.call('SADD', KEYS[2], ARGV[1])
+    redis.call('EXPIRE', KEYS[2], ARGV[2])
+    redis.call('XADD', KEYS[4], '*', 'post_id', ARGV[3], 'user', ARGV[1], 'reaction', ARGV[4], 'op', 'add')
+    if redis.call('SREM', KEYS[3], ARGV[1]) == 1 then
+        redis.call('XADD', KEYS[4], '*', 'post_id', ARGV[3], 'user', ARGV[1], 'reaction', ARGV[5], 'op', 'remove')
+    end
+end
+redis.call('PUBLISH', ARGV[6], ARGV[3])
+return {redis.call('SCARD', KEYS[2]), redis.call('SCARD', KEYS[3])}
+"""
+toggle_reaction_script = redis.register_script(TOGGLE_REACTION_LUA)
+
+# Удаляет лок, только если он все еще принадлежит тому, кто его ставил
+RELEASE_LOCK_LUA = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+release_lock_script = redis.register_script(RELEASE_LOCK_LUA)
+
+# Загрузки постов из бд, которые сейчас выполняются в этом воркере: айди поста -> таска загрузки
+_loads_in_flight: dict[int, asyncio.Task] = {}
+# Фоновые обновления постов, которые скоро истекут в кэше
+_background_refreshes: dict[int, asyncio.Task] = {}
+# Чтения постов, которые еще не перенесены в рейтинг читаемости: айди поста -> количество
+_pending_reads: Counter = Counter()
+
+
+async def fetch_post_from_cache(db: AsyncSession, post_id: int, hot_only: bool = False,
+                                count_read: bool = True) -> dict | JSONResponse:
+    """Возвращает запись поста из локального кэша воркера или из редиса, а в случае ее отсутствия берет ее из бд,
+     добавляет в кэш(назначает ttl 168 часов) и возвращает. Если поста по указанному айдишнику нет,
+     то вернет код 400 с описанием ошибки. Если кэш недоступен, то вернет пост из бд.
+     С hot_only из редиса читается только горячее поле, и пост возвращается без описания.
+     Внутренние проверки передают count_read=False, чтобы не влиять на рейтинг читаемости для прогрева"""
+    if count_read:
+        count_post_reads([post_id])
+    local_post = get_local_post(post_id)
+    if local_post:
+        return _without_description(local_post) if hot_only else local_post
 
-def fetch_post_from_cache(db: Session, post_id: int) -> dict | JSONResponse:
-    """Возвращает запись поста из кэша, а в случае ее отсутствия берет ее из бд, добавляет в кэш(назначает ttl 168 часов)
-     и возвращает. Если поста по указанному айдишнику нет, то вернет код 400 с описанием ошибки
-     Если кэш недоступен, то вернет пост из бд."""
     try:
-        response = redis.hgetall(post_id)
+        pipe = binary_redis.pipeline(transaction=False)
+        _read_post(pipe, post_id, hot_only=hot_only)
+        response = _build_post(post_id, *(await pipe.execute())[:4])
+        POSTS_CACHE_LOOKUPS.labels('hit' if response else 'miss').inc()
         if response:
+            if not hot_only:
+                set_local_post(response)
             return response
         else:
-            post_from_db = fetch_one_post(db=db, post_id=post_id)
-            if isinstance(post_from_db, dict):
-                redis.hset(post_from_db['id'], mapping=post_from_db)
-                ttl = datetime.timedelta(hours=settings.TTL)
-                redis.expire(post_from_db['id'], time=ttl)
-                return post_from_db
+            post_from_db = (await load_posts(db=db, post_ids=[post_id])).get(post_id)
+            if post_from_db:
+                set_local_post(post_from_db)
+                return _without_description(post_from_db) if hot_only else post_from_db
             else:
                 return JSONResponse(status_code=200, content={'Message': 'Post not exist'})
-    except ConnectionError as err:
+    except (ConnectionError, TimeoutError) as err:
+        logger.error(err)
+        CACHE_FALLBACKS.labels('fetch_post').inc()
+        post = await fetch_one_post(db=db, post_id=post_id)
+        return _without_description(post) if hot_only and isinstance(post, dict) else post
+
+
+async def fetch_posts_from_cache(post_ids: list[int], db: AsyncSession, hot_only: bool = False) -> list:
+    """Возвращает список постов по указанным айди из кэша в том же порядке. Все записи забираются из кэша
+    одним пайплайном, недостающие подгружаются из бд одним запросом и тоже одним пайплайном докладываются в кэш.
+    Если кэш недоступен, то вернет посты из бд. С hot_only посты возвращаются без описания,
+    и из редиса читаются только их горячие поля"""
+    if not post_ids:
+        return []
+
+    count_post_reads(post_ids)
+    cached_posts = {post_id: get_local_post(post_id) for post_id in post_ids}
+    remote_ids = [post_id for post_id, post in cached_posts.items() if not post]
+    try:
+        pipe = binary_redis.pipeline(transaction=False)
+        for post_id in remote_ids:
+            _read_post(pipe, post_id, hot_only=hot_only)
+        replies = await pipe.execute() if remote_ids else []
+        for i, post_id in enumerate(remote_ids):
+            cached_posts[post_id] = _build_post(post_id, *replies[i * 4:i * 4 + 4])
+
+        # В локальный кэш кладутся только полные посты: из бд или прочитанные из редиса целиком
+        full_ids = [] if hot_only else [post_id for post_id in remote_ids if cached_posts[post_id]]
+        missed_ids = [post_id for post_id in remote_ids if not cached_posts[post_id]]
+        POSTS_CACHE_LOOKUPS.labels('hit').inc(len(remote_ids) - len(missed_ids))
+        POSTS_CACHE_LOOKUPS.labels('miss').inc(len(missed_ids))
+        if missed_ids:
+            cached_posts.update(await load_posts(db=db, post_ids=missed_ids))
+            full_ids.extend(missed_ids)
+    except (ConnectionError, TimeoutError) as err:
+        logger.error(err)
+        CACHE_FALLBACKS.labels('fetch_posts').inc()
+        for post in await fetch_posts_by_ids(db=db, post_ids=remote_ids):
+            cached_posts[post['id']] = post
+        full_ids = remote_ids
+
+    for post_id in full_ids:
+        if cached_posts.get(post_id):
+            set_local_post(cached_posts[post_id])
+
+    posts = [cached_posts[post_id] for post_id in post_ids if cached_posts.get(post_id)]
+    return [_without_description(post) for post in posts] if hot_only else posts
+
+
+def count_post_reads(post_ids: list[int]) -> None:
+    """Учитывает чтения постов, в том числе из локального кэша. В редис они переносятся пачкой в flush_post_reads"""
+    _pending_reads.update(post_ids)
+
+
+async def flush_post_reads() -> None:
+    """Одним пайплайном переносит накопленные чтения в рейтинг читаемости. Если редис недоступен,
+    то чтения теряются: рейтинг приблизительный и нужен только для прогрева"""
+    reads = dict(_pending_reads)
+    _pending_reads.clear()
+    if not reads:
+        return
+    try:
+        pipe = redis.pipeline(transaction=False)
+        for post_id, count in reads.items():
+            pipe.zincrby(POSTS_READS_KEY, count, post_id)
+        await pipe.execute()
+    except RedisError as err:
         logger.error(err)
-        return fetch_one_post(db=db, post_id=post_id)
 
 
-def fetch_posts_from_cache(quantity: int, db: Session) -> list:
-    """Возвращает список постов из кэша"""
-    posts_for_response = []
-    for i in range(1, quantity + 1):
-        post = fetch_post_from_cache(db=db, post_id=i)
+async def flush_post_reads_periodically(interval: float) -> None:
+    """Фоновая задача воркера апи: раз в interval секунд переносит чтения постов в редис"""
+    while True:
+        await asyncio.sleep(interval)
+        await flush_post_reads()
+
+
+def _without_description(post: dict) -> dict:
+    return {field: value for field, value in post.items() if field != 'description'}
+
+
+def _read_post(pipe, post_id: int, hot_only: bool = False) -> None:
+    """Добавляет в пайплайн чтение полей поста (только горячего, если hot_only), количества юзеров в множествах
+    лайков/дизлайков и ttl"""
+    fields = (HOT_FIELD,) if hot_only else (HOT_FIELD, COLD_FIELD)
+    pipe.hmget(post_key(post_id), *fields)
+    pipe.scard(reactors_key(post_id, 'like_user'))
+    pipe.scard(reactors_key(post_id, 'dislike_user'))
+    pipe.pttl(post_key(post_id))
+
+
+def _build_post(post_id: int, fields: list, likes: int, dislikes: int, ttl: int) -> dict:
+    """Собирает пост из ответов пайплайна. Если поста в кэше нет или он записан в другом формате,
+    то вернет пустой словарь. Если пост скоро истечет, то запускает его фоновое обновление,
+    а пока отдает текущую версию"""
+    post = unpack_hot(fields[0])
+    if post is None:
+        return {}
+    if len(fields) > 1:
+        post['description'] = unpack_cold(fields[1])
+        if post['description'] is None:
+            return {}
+
+    delta = post.pop('delta')
+    post['likes'] = likes
+    post['dislikes'] = dislikes
+    if _should_refresh_early(delta=delta, ttl=ttl):
+        refresh_post_in_background(post_id=post_id)
+    return post
+
+
+def _should_refresh_early(delta: int, ttl: int) -> bool:
+    """Вероятностное досрочное обновление (XFetch): чем ближе истечение записи и чем дольше она грузится из бд
+    (delta, мс), тем выше шанс, что очередной запрос обновит ее заранее, и тем меньше шанс массового промаха"""
+    if ttl < 0 or delta <= 0:
+        return False
+    return -delta * settings.CACHE_EARLY_REFRESH_BETA * math.log(1.0 - random.random()) >= ttl
+
+
+async def load_posts(db: AsyncSession, post_ids: list[int]) -> dict[int, dict]:
+    """Загружает посты, которых нет в кэше, и кладет их в кэш. Одновременные загрузки одного поста
+    внутри воркера объединяются в одну, а между воркерами разводятся коротким локом в редисе"""
+    new_ids = [post_id for post_id in post_ids if post_id not in _loads_in_flight]
+    if new_ids:
+        task = asyncio.ensure_future(_load_posts_with_lock(db=db, post_ids=new_ids))
+        for post_id in new_ids:
+            _loads_in_flight[post_id] = task
+        task.add_done_callback(lambda done: _forget_loads(done, new_ids))
+
+    tasks = {_loads_in_flight[post_id] for post_id in post_ids if post_id in _loads_in_flight}
+    posts = {}
+    for task in tasks:
+        posts.update(await asyncio.shield(task))
+    return {post_id: posts[post_id] for post_id in post_ids if post_id in posts}
+
+
+def _forget_loads(task: asyncio.Task, post_ids: list[int]) -> None:
+    for post_id in post_ids:
+        if _loads_in_flight.get(post_id) is task:
+            del _loads_in_flight[post_id]
+
+
+async def _load_posts_with_lock(db: AsyncSession, post_ids: list[int]) -> dict[int, dict]:
+    """Берет локи на загрузку постов. Посты, лок на которые уже держит другой воркер, какое-то время ждет в кэше,
+    остальные загружает из бд одним запросом, кладет в кэш и отпускает локи"""
+    token = uuid.uuid4().hex
+    pipe = redis.pipeline(transaction=False)
+    for post_id in post_ids:
+        pipe.set(post_lock_key(post_id), token, nx=True, px=settings.CACHE_LOCK_TIMEOUT)
+    locked = await pipe.execute()
+
+    posts = {}
+    contended_ids = [post_id for post_id, acquired in zip(post_ids, locked) if not acquired]
+    if contended_ids:
+        posts.update(await _wait_for_cached_posts(post_ids=contended_ids))
+
+    ids_to_load = [post_id for post_id in post_ids if post_id not in posts]
+    try:
+        posts.update(await _load_and_cache_posts(db=db, post_ids=ids_to_load))
+    finally:
+        pipe = redis.pipeline(transaction=False)
+        for post_id, acquired in zip(post_ids, locked):
+            if acquired:
+                await release_lock_script(keys=[post_lock_key(post_id)], args=[token], client=pipe)
+        await pipe.execute()
+    return posts
+
+
+async def _wait_for_cached_posts(post_ids: list[int]) -> dict[int, dict]:
+    """Ждет, пока другой воркер положит посты в кэш. Если не дождался, то вернет только то, что появилось"""
+    posts = {}
+    for _ in range(settings.CACHE_LOCK_WAIT_ATTEMPTS):
+        await asyncio.sleep(settings.CACHE_LOCK_WAIT_INTERVAL)
+        waiting_ids = [post_id for post_id in post_ids if post_id not in posts]
+        pipe = binary_redis.pipeline(transaction=False)
+        for post_id in waiting_ids:
+            _read_post(pipe, post_id)
+        replies = await pipe.execute()
+        for i, post_id in enumerate(waiting_ids):
+            post = _build_post(post_id, *replies[i * 4:i * 4 + 4])
+            if post:
+                posts[post_id] = post
+        if len(posts) == len(post_ids):
+            break
+    return posts
+
+
+async def _load_and_cache_posts(db: AsyncSession, post_ids: list[int]) -> dict[int, dict]:
+    """Загружает посты из бд одним запросом и кладет их в кэш вместе со временем загрузки. На реакции из бд
+    накладываются записи журнала, которые еще не перенесены в бд, иначе они пропали бы из кэша до переноса"""
+    if not post_ids:
+        return {}
+
+    # Журнал читается до бд: записи, перенесенные между чтениями, применятся повторно с тем же итогом
+    pending = await redis.xrange(REACTIONS_JOURNAL_KEY)
+    started = time.perf_counter()
+    posts_from_db = await fetch_posts_by_ids(db=db, post_ids=post_ids)
+    apply_pending_reactions(posts=posts_from_db, entries=pending)
+    delta = max(int((time.perf_counter() - started) * 1000), 1)
+    await cache_posts(posts=posts_from_db, delta=delta)
+    return {post['id']: post for post in posts_from_db}
+
+
+def refresh_post_in_background(post_id: int) -> None:
+    """Запускает фоновое обновление поста в кэше, если оно еще не запущено в этом воркере"""
+    if post_id in _background_refreshes:
+        return
+    task = asyncio.ensure_future(_refresh_post(post_id=post_id))
+    _background_refreshes[post_id] = task
+    task.add_done_callback(lambda done: _background_refreshes.pop(post_id, None))
+
+
+async def drain_background_refreshes(timeout: float) -> None:
+    """Дожидается запущенных фоновых обновлений кэша при остановке воркера, чтобы они не оборвались на середине"""
+    if _background_refreshes:
+        await asyncio.wait(list(_background_refreshes.values()), timeout=timeout)
+
+
+async def _refresh_post(post_id: int) -> None:
+    """Перечитывает данные поста из бд и продлевает ttl. Множества лайков/дизлайков не перезаписываются:
+    в них могут быть изменения, которые еще не перенесены из журнала в бд"""
+    token = uuid.uuid4().hex
+    try:
+        if not await redis.set(post_lock_key(post_id), token, nx=True, px=settings.CACHE_LOCK_TIMEOUT):
+            return
         try:
-            if 'id' not in post.keys():
-                continue
-        except AttributeError as err:
-            continue
-        else:
-            posts_for_response.append(post)
-    return posts_for_response
+            started = time.perf_counter()
+            async with AsyncSessionLocal() as db:
+                posts = await fetch_posts_by_ids(db=db, post_ids=[post_id])
+            delta = max(int((time.perf_counter() - started) * 1000), 1)
+            if not posts:
+                return
+
+            ttl = datetime.timedelta(hours=settings.TTL)
+            pipe = binary_redis.pipeline(transaction=False)
+            pipe.hset(post_key(post_id), mapping=post_cache_fields(post=posts[0], delta=delta))
+            pipe.expire(post_key(post_id), time=ttl)
+            for users in REACTORS_FIELDS:
+                pipe.expire(reactors_key(post_id, users), time=ttl)
+            await pipe.execute()
+        finally:
+            await release_lock_script(keys=[post_lock_key(post_id)], args=[token])
+    except Exception as err:
+        logger.exception(err)
 
 
-def change_count_of_users_emotions(db: Session, user: UserInDB, post_id: int, users: str,
-                                   model: Likes | Dislikes) -> JSONResponse:
-    """Инкрементирует/декрементирует счетчик лайков в кэше.
+async def cache_posts(posts: list[dict], delta: int = 0) -> None:
+    """Одним пайплайном добавляет посты в кэш и назначает им ttl. Данные поста хранятся в хэше упакованными
+    (см. posts.serialization), а айдишники юзеров, поставивших лайк/дизлайк, в отдельных множествах.
+    Множества пересобираются целиком, поэтому в posts уже должны быть учтены записи журнала"""
+    if not posts:
+        return
+
+    ttl = datetime.timedelta(hours=settings.TTL)
+    pipe = binary_redis.pipeline(transaction=False)
+    for post in posts:
+        pipe.hdel(post_key(post['id']), *LEGACY_FIELDS)
+        pipe.hset(post_key(post['id']), mapping=post_cache_fields(post=post, delta=delta))
+        pipe.expire(post_key(post['id']), time=ttl)
+        for users in REACTORS_FIELDS:
+            key = reactors_key(post['id'], users)
+            pipe.delete(key)
+            if post[users]:
+                pipe.sadd(key, *post[users].split(':'))
+                pipe.expire(key, time=ttl)
+    await pipe.execute()
+
+
+async def check_post_author_in_cache(db: AsyncSession, post_id: int, user: UserInDB) -> bool:
+    """Проверка текущего юзера на авторство поста для лайка/дизлайка по посту из кэша, без отдельного запроса в бд"""
+    post = await fetch_post_from_cache(db=db, post_id=post_id, hot_only=True, count_read=False)
+    return isinstance(post, dict) and str(post['author']) == str(user.id)
+
+
+async def change_count_of_users_emotions(db: AsyncSession, user: UserInDB, post_id: int, users: str,
+                                         model: Likes | Dislikes) -> JSONResponse:
+    """Атомарно ставит/снимает лайк или дизлайк lua скриптом за один запрос к редису. При постановке реакции
+    противоположная снимается. Возвращает количество лайков и дизлайков после изменения.
      Если поста нет в кэше то берет данные из бд"""
+    opposite_users = OPPOSITE_REACTORS[users]
+    call = _toggle_reaction_call(user=user, post_id=post_id, users=users)
     try:
-        new_req = redis.hgetall(post_id)
-        if not new_req:
-            single_post = fetch_one_post(db=db, post_id=post_id)
-            if not single_post:
+        counts = await toggle_reaction_script(**call)
+        if counts is None:
+            if post_id not in await load_posts(db=db, post_ids=[post_id]):
                 raise HTTPException(status_code=400, detail='Post not exists')
+            counts = await toggle_reaction_script(**call)
+
+        local_posts_cache.invalidate(post_id)
+        count, opposite_count = counts
+        return JSONResponse(status_code=201, content={REACTORS_TABLES[users]: count,
+                                                      REACTORS_TABLES[opposite_users]: opposite_count})
+    except RedisError as err:
+        logger.error(err)
+        CACHE_FALLBACKS.labels('toggle_reaction').inc()
+        return await change_emotions_in_db(post_id=post_id, db=db, user=user, model=model)
+
 
-            redis.hset(post_id, mapping=single_post)
-            ttl = datetime.timedelta(hours=720)
-            redis.expire(post_id, time=ttl)
-
-        request_after_update = redis.hget(post_id, users)
-        users_list = request_after_update.split(':')
-        table = model.__tablename__
-        if str(user.id) in users_list:
-            users_list.remove(str(user.id))
-            table_data = ':'.join(users_list)
-            redis.hincrby(post_id, table, -1)
-            redis.hset(post_id, users, table_data)
-            return JSONResponse(status_code=201, content={table: redis.hget(post_id, table)})
+def _toggle_reaction_call(user: UserInDB, post_id: int, users: str) -> dict:
+    """Ключи и аргументы lua скрипта переключения реакции"""
+    opposite_users = OPPOSITE_REACTORS[users]
+    return {'keys': [post_key(post_id), reactors_key(post_id, users), reactors_key(post_id, opposite_users),
+                     REACTIONS_JOURNAL_KEY],
+            'args': [user.id, settings.TTL * 3600, post_id, users, opposite_users, POSTS_INVALIDATION_CHANNEL]}
+
+
+async def _toggle_reactions_in_pipeline(calls: list[dict]) -> list:
+    pipe = redis.pipeline(transaction=False)
+    for call in calls:
+        await toggle_reaction_script(client=pipe, **call)
+    return await pipe.execute()
+
+
+async def change_reactions_in_bulk(db: AsyncSession, user: UserInDB, reactions: list) -> list[dict]:
+    """Переключает пачку реакций юзера. Авторство всех постов проверяется одним запросом, все переключения
+    выполняются одним пайплайном lua скриптов в порядке запроса. Посты, которых нет в кэше, подгружаются
+    одним запросом, и их переключения повторяются вторым пайплайном. Возвращает результат по каждой реакции"""
+    authors = await select_posts_authors(db=db, post_ids=[reaction.post_id for reaction in reactions])
+    results, accepted = [], []
+    for reaction in reactions:
+        result = {'post_id': reaction.post_id, 'reaction': reaction.reaction}
+        results.append(result)
+        if reaction.post_id not in authors:
+            result['error'] = 'Post not exists'
+        elif authors[reaction.post_id] == user.id:
+            result['error'] = "You can't like or dislike your own posts"
         else:
-            users_list.append(str(user.id))
-            if "" in users_list:
-                users_list.remove("")
-            table_data_users = ':'.join(users_list)
-            redis.hincrby(post_id, table, 1)
-            redis.hset(post_id, users, table_data_users)
-            return JSONResponse(status_code=201, content={table: redis.hget(post_id, table)})
+            accepted.append(result)
+
+    calls = [_toggle_reaction_call(user=user, post_id=result['post_id'], users=REACTIONS[result['reaction']][0])
+             for result in accepted]
+    try:
+        counts = await _toggle_reactions_in_pipeline(calls)
+        missed = [i for i, count in enumerate(counts) if count is None]
+        if missed:
+            await load_posts(db=db, post_ids=list({accepted[i]['post_id'] for i in missed}))
+            for i, count in zip(missed, await _toggle_reactions_in_pipeline([calls[i] for i in missed])):
+                counts[i] = count
     except RedisError as err:
         logger.error(err)
-        return change_emotions_in_db(post_id=post_id, db=db, user=user, model=model)
+        CACHE_FALLBACKS.labels('toggle_reactions_bulk').inc()
+        counts = []
+        for result in accepted:
+            users, model = REACTIONS[result['reaction']]
+            response = await change_emotions_in_db(post_id=result['post_id'], db=db, user=user, model=model)
+            emotions = json.loads(response.body)
+            counts.append((emotions[REACTORS_TABLES[users]], emotions[REACTORS_TABLES[OPPOSITE_REACTORS[users]]]))
+
+    for result, count in zip(accepted, counts):
+        local_posts_cache.invalidate(result['post_id'])
+        if count is None:
+            result['error'] = 'Post not exists'
+            continue
+        users = REACTIONS[result['reaction']][0]
+        result[REACTORS_TABLES[users]], result[REACTORS_TABLES[OPPOSITE_REACTORS[users]]] = count
+    return results
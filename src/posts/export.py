@@ -0,0 +1,54 @@
+import json
+from typing import AsyncIterator, Iterator
+
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+from posts.models import Post, Likes, Dislikes
+from config.base import settings
+from config.db import AsyncSessionLocal, group_concat_ids
+
+
+def build_posts_export_query(author: int | None = None, after_id: int | None = None, before_id: int | None = None,
+                             reactors: bool = False):
+    """Запрос постов для выгрузки по возрастанию айди вместе со счетчиками. Если reactors=True, то добавляются
+    склеенные через ':' айдишники юзеров, поставивших лайк/дизлайк (коррелированный подзапрос по индексу post_id)"""
+    columns = [Post.id, Post.title, Post.description, Post.author, Post.likes_count, Post.dislikes_count]
+    if reactors:
+        for model in (Likes, Dislikes):
+            columns.append(select(group_concat_ids(model.user)).where(model.post_id == Post.id).scalar_subquery())
+
+    query = select(*columns)
+    if author is not None:
+        query = query.where(Post.author == author)
+    if after_id is not None:
+        query = query.where(Post.id > after_id)
+    if before_id is not None:
+        query = query.where(Post.id < before_id)
+    return query.order_by(Post.id).execution_options(yield_per=settings.EXPORT_BATCH_SIZE)
+
+
+def format_export_row(row) -> str:
+    """Строка NDJSON с одним постом"""
+    post = {'id': row[0], 'title': row[1], 'description': row[2], 'author': row[3],
+            'likes': row[4], 'dislikes': row[5]}
+    if len(row) > 6:
+        post['like_user'] = [int(user) for user in row[6].split(':')] if row[6] else []
+        post['dislike_user'] = [int(user) for user in row[7].split(':')] if row[7] else []
+    return json.dumps(post, ensure_ascii=False) + '\n'
+
+
+async def stream_posts_export(**filters) -> AsyncIterator[str]:
+    """Отдает посты в формате NDJSON пачками по EXPORT_BATCH_SIZE через серверный курсор. В памяти держится
+    только текущая пачка, кэш не используется. Сессия открывается своя, так как генератор живет дольше запроса"""
+    async with AsyncSessionLocal() as db:
+        result = await db.stream(build_posts_export_query(**filters))
+        async for rows in result.partitions():
+            yield ''.join(format_export_row(row) for row in rows)
+
+
+def iter_posts_export(db: Session, **filters) -> Iterator[str]:
+    """Синхронный вариант stream_posts_export для выгрузки из командной строки"""
+    result = db.execute(build_posts_export_query(**filters))
+    for rows in result.partitions():
+        yield ''.join(format_export_row(row) for row in rows)
@@ -0,0 +1,37 @@
+import logging
+
+from redis.exceptions import RedisError
+
+from config.base import manager, settings
+from config.invalidation import register_invalidation_channel
+from config.lru import LRUCache
+
+redis = manager.redis
+logger = logging.getLogger('app.posts.local_cache')
+
+# Канал, в который публикуются айди измененных постов, чтобы остальные воркеры сбросили их из локального кэша
+POSTS_INVALIDATION_CHANNEL = 'posts:invalidate'
+
+local_posts_cache = LRUCache(name='posts', max_items=settings.LOCAL_CACHE_MAX_ITEMS,
+                             max_bytes=settings.LOCAL_CACHE_MAX_BYTES, ttl=settings.LOCAL_CACHE_TTL)
+register_invalidation_channel(POSTS_INVALIDATION_CHANNEL, local_posts_cache, key=int)
+
+
+def get_local_post(post_id: int) -> dict | None:
+    """Возвращает копию поста из локального кэша воркера"""
+    post = local_posts_cache.get(int(post_id))
+    return dict(post) if post else None
+
+
+def set_local_post(post: dict) -> None:
+    """Кладет копию поста в локальный кэш воркера"""
+    local_posts_cache.set(int(post['id']), dict(post))
+
+
+async def publish_post_invalidation(post_id: int) -> None:
+    """Сбрасывает пост из локального кэша и сообщает об изменении остальным воркерам"""
+    local_posts_cache.invalidate(int(post_id))
+    try:
+        await redis.publish(POSTS_INVALIDATION_CHANNEL, post_id)
+    except RedisError as err:
+        logger.error(err)
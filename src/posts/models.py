@@ -1,4 +1,4 @@
-from sqlalchemy import Column, ForeignKey, Integer, String, Text
+from sqlalchemy import BigInteger, Column, ForeignKey, Index, Integer, String, Text
 from sqlalchemy.orm import relationship
 
 from config.db import Base
@@ -11,6 +11,8 @@ class Post(Base):
     title = Column(String(150), nullable=False)
     description = Column(Text, nullable=False)
     author = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"))
+    likes_count = Column(Integer, nullable=False, default=0, server_default='0')
+    dislikes_count = Column(Integer, nullable=False, default=0, server_default='0')
 
     like = relationship("Likes", backref="post", passive_deletes=True)
     dislike = relationship("Dislikes", backref="post", passive_deletes=True)
@@ -18,6 +20,7 @@ class Post(Base):
 
 class Dislikes(Base):
     __tablename__ = "dislikes"
+    __table_args__ = (Index('ix_dislikes_post_id_user', 'post_id', 'user', unique=True),)
 
     id = Column(Integer, primary_key=True, index=True)
     post_id = Column(Integer, ForeignKey('posts.id', ondelete='CASCADE'), nullable=False)
@@ -26,7 +29,26 @@ class Dislikes(Base):
 
 class Likes(Base):
     __tablename__ = "likes"
+    __table_args__ = (Index('ix_likes_post_id_user', 'post_id', 'user', unique=True),)
 
     id = Column(Integer, primary_key=True, index=True)
     post_id = Column(Integer, ForeignKey('posts.id', ondelete='CASCADE'), nullable=False)
     user = Column(Integer, ForeignKey('users.id', ondelete='CASCADE'), nullable=False)
+
+
+class StaleCachedPost(Base):
+    """Посты, которые менялись напрямую в бд, пока редис был недоступен. После восстановления редиса
+    их записи в кэше пересобираются. Внешнего ключа нет, чтобы удаленные посты тоже вычищались из кэша"""
+    __tablename__ = "stale_cached_posts"
+
+    post_id = Column(Integer, primary_key=True)
+
+
+class StaleReaction(Base):
+    """Реакции, измененные напрямую в бд, пока редис был недоступен. Записи журнала по той же паре пост-юзер,
+    сделанные раньше changed_at (мс), при переносе в бд пропускаются, чтобы не перезаписать более позднее изменение"""
+    __tablename__ = "stale_reactions"
+
+    post_id = Column(Integer, primary_key=True)
+    user = Column(Integer, primary_key=True)
+    changed_at = Column(BigInteger, nullable=False)
@@ -1,14 +1,18 @@
 import fastapi
-from fastapi import Depends, HTTPException
-from sqlalchemy.orm import Session
+from fastapi import Depends, HTTPException, Query, Response
+from sqlalchemy.ext.asyncio import AsyncSession
 from starlette import status
-from starlette.responses import JSONResponse
+from starlette.responses import JSONResponse, StreamingResponse
 
 from config.db import get_db
-from posts.cache import fetch_posts_from_cache, fetch_post_from_cache, change_count_of_users_emotions
+from posts.cache import fetch_posts_from_cache, fetch_post_from_cache, change_count_of_users_emotions, \
+    check_post_author_in_cache, change_reactions_in_bulk
+from posts.export import stream_posts_export
 from posts.models import Post, Likes, Dislikes
-from posts.schemas import PostInDB, PostCreate, PostUpdate
-from posts.services import add_new_post_in_db, update_post, remove_post_from_db, check_post_author
+from posts.schemas import PostInDB, PostSummary, PostCreate, PostUpdate, PostsBulkCreate, ReactionsBulk
+from posts.services import add_new_post_in_db, update_post, remove_post_from_db, check_post_author, \
+    select_posts_ids_page, add_new_posts_in_db
+from posts.utils import encode_cursor, decode_cursor
 from users.schemas import UserInDB
 from users.utils import get_current_user
 
@@ -16,8 +20,8 @@ post_router = fastapi.APIRouter()
 
 
 @post_router.post('/', response_model=PostInDB, status_code=status.HTTP_201_CREATED)
-def create_new_post(post: PostCreate, db: Session = Depends(get_db),
-                    user: UserInDB = Depends(get_current_user)) -> Post:
+async def create_new_post(post: PostCreate, db: AsyncSession = Depends(get_db),
+                          user: UserInDB = Depends(get_current_user)) -> Post:
     """
     Create new post:
     - **title**: length must be [1-150]
@@ -32,13 +36,31 @@ def create_new_post(post: PostCreate, db: Session = Depends(get_db),
     "author": 1
     }
     """
-    return add_new_post_in_db(db=db, obj_in=post, user=user)
+    return await add_new_post_in_db(db=db, obj_in=post, user=user)
 
 
-@post_router.get('/', response_model=list[PostInDB], status_code=status.HTTP_200_OK)
-def get_all_posts(db: Session = Depends(get_db), skip: int = 0, limit: int = 100) -> list[Post]:
+@post_router.post('/bulk', response_model=list[PostInDB], status_code=status.HTTP_201_CREATED)
+async def create_new_posts(posts: PostsBulkCreate, db: AsyncSession = Depends(get_db),
+                           user: UserInDB = Depends(get_current_user)) -> list[Post]:
     """
-    - Return json of posts list.
+    Create up to BULK_MAX_ITEMS posts in one request, posts are saved with one commit:
+    - **posts**: list of {"title": "string", "description": "string"}
+    - Return json of created posts list in the same order.
+    """
+    return await add_new_posts_in_db(db=db, objs_in=posts.posts, user=user)
+
+
+@post_router.get('/', response_model=list[PostInDB | PostSummary], status_code=status.HTTP_200_OK)
+async def get_all_posts(response: Response, db: AsyncSession = Depends(get_db), skip: int = 0,
+                        limit: int = Query(default=100, ge=1, le=1000), after_id: int | None = None,
+                        before_id: int | None = None, cursor: str | None = None,
+                        summary: bool = False) -> list[Post]:
+    """
+    - **after_id**: return posts with id greater than after_id
+    - **before_id**: return posts with id less than before_id
+    - **cursor**: opaque token from X-Next-Cursor/X-Prev-Cursor headers, overrides after_id/before_id
+    - **summary**: return posts without description, only the small fields are read from the cache
+    - Return json of posts list ordered by id.
     - Example:   {
     "title": "string",
     "description": "string",
@@ -49,11 +71,34 @@ def get_all_posts(db: Session = Depends(get_db), skip: int = 0, limit: int = 100
     },
     {...}
     """
-    return fetch_posts_from_cache(quantity=limit, db=db)
+    if cursor:
+        after_id, before_id = decode_cursor(cursor)
+
+    post_ids = await select_posts_ids_page(db=db, limit=limit, after_id=after_id, before_id=before_id, skip=skip)
+    if post_ids:
+        response.headers['X-Next-Cursor'] = encode_cursor(after_id=post_ids[-1])
+        response.headers['X-Prev-Cursor'] = encode_cursor(before_id=post_ids[0])
+    return await fetch_posts_from_cache(post_ids=post_ids, db=db, hot_only=summary)
+
+
+@post_router.get('/export', response_class=StreamingResponse, status_code=status.HTTP_200_OK)
+async def export_posts(author: int | None = None, after_id: int | None = None, before_id: int | None = None,
+                       reactors: bool = False, user: UserInDB = Depends(get_current_user)) -> StreamingResponse:
+    """
+    Stream all posts ordered by id as NDJSON (one json object per line), memory use does not depend on table size.
+    Data is read from the database, so reactions from the last few seconds may not be included yet:
+    - **author**: only posts of this author
+    - **after_id** / **before_id**: id range, both bounds are exclusive
+    - **reactors**: add like_user/dislike_user lists of user ids
+    - Example line:   {"id": 3, "title": "string", "description": "string", "author": 1, "likes": 1, "dislikes": 2}
+    """
+    return StreamingResponse(stream_posts_export(author=author, after_id=after_id, before_id=before_id,
+                                                 reactors=reactors),
+                             media_type='application/x-ndjson')
 
 
 @post_router.get('/{post_id}', response_model=PostInDB, status_code=status.HTTP_200_OK)
-def get_post(post_id: int, db: Session = Depends(get_db)) -> dict | JSONResponse:
+async def get_post(post_id: int, db: AsyncSession = Depends(get_db)) -> dict | JSONResponse:
     """
     - Return json.
     - Example:   {
@@ -65,12 +110,12 @@ def get_post(post_id: int, db: Session = Depends(get_db)) -> dict | JSONResponse
     "author": 1
     }
     """
-    return fetch_post_from_cache(db=db, post_id=post_id)
+    return await fetch_post_from_cache(db=db, post_id=post_id)
 
 
 @post_router.patch('/{post_id}', response_model=PostInDB, status_code=status.HTTP_201_CREATED)
-def edit_post(post_id: int, obj_in: PostUpdate, db: Session = Depends(get_db)
-              , user: UserInDB = Depends(get_current_user)) -> Post:
+async def edit_post(post_id: int, obj_in: PostUpdate, db: AsyncSession = Depends(get_db)
+                    , user: UserInDB = Depends(get_current_user)) -> Post:
     """
     - **title**: length must be [1-150]
     - **description**:length must be [1-5000]
@@ -80,46 +125,60 @@ def edit_post(post_id: int, obj_in: PostUpdate, db: Session = Depends(get_db)
     "description": "string",
     }
     """
-    if check_post_author(db, post_id, user):
-        return update_post(db=db, post_id=post_id, obj_in=obj_in)
+    if await check_post_author(db, post_id, user):
+        return await update_post(db=db, post_id=post_id, obj_in=obj_in)
     else:
         raise HTTPException(status_code=400, detail="You can't edit this post. Permission denied.")
 
 
 @post_router.delete('/{post_id}', response_model=PostInDB, status_code=status.HTTP_200_OK)
-def delete_post(post_id: int, db: Session = Depends(get_db),
-                user: UserInDB = Depends(get_current_user)) -> JSONResponse:
+async def delete_post(post_id: int, db: AsyncSession = Depends(get_db),
+                      user: UserInDB = Depends(get_current_user)) -> JSONResponse:
     """
     - Return json.
     - Example:   {"Message": "Post deleted"}
     """
-    if check_post_author(db, post_id, user):
-        return remove_post_from_db(db, post_id)
+    if await check_post_author(db, post_id, user):
+        return await remove_post_from_db(db, post_id)
     else:
         raise HTTPException(status_code=400, detail="You can't delete this post. Permission denied.")
 
 
 @post_router.post('/like/{post_id}')
-def add_or_remove_like(post_id: int, db: Session = Depends(get_db),
-                       user: UserInDB = Depends(get_current_user)) -> JSONResponse:
+async def add_or_remove_like(post_id: int, db: AsyncSession = Depends(get_db),
+                             user: UserInDB = Depends(get_current_user)) -> JSONResponse:
     """
     - Return json.
-    - Example:   {"likes": value}
+    - Example:   {"likes": value, "dislikes": value}
     """
-    if not check_post_author(db, post_id, user):
-        return change_count_of_users_emotions(db=db, user=user, post_id=post_id, users='like_user', model=Likes)
+    if not await check_post_author_in_cache(db, post_id, user):
+        return await change_count_of_users_emotions(db=db, user=user, post_id=post_id, users='like_user', model=Likes)
     else:
         raise HTTPException(status_code=400, detail="You can't like or dislike your own posts")
 
 
 @post_router.post('/dislike/{post_id}')
-def add_or_remove_dislike(post_id: int, db: Session = Depends(get_db),
-                          user: UserInDB = Depends(get_current_user)) -> JSONResponse:
+async def add_or_remove_dislike(post_id: int, db: AsyncSession = Depends(get_db),
+                                user: UserInDB = Depends(get_current_user)) -> JSONResponse:
     """
     - Return json.
-    - Example:   {"dislikes": value}
+    - Example:   {"dislikes": value, "likes": value}
     """
-    if not check_post_author(db, post_id, user):
-        return change_count_of_users_emotions(db=db, user=user, post_id=post_id, users='dislike_user', model=Dislikes)
+    if not await check_post_author_in_cache(db, post_id, user):
+        return await change_count_of_users_emotions(db=db, user=user, post_id=post_id, users='dislike_user',
+                                                    model=Dislikes)
     else:
         raise HTTPException(status_code=400, detail="You can't like or dislike your own posts")
+
+
+@post_router.post('/reactions')
+async def toggle_reactions(reactions: ReactionsBulk, db: AsyncSession = Depends(get_db),
+                           user: UserInDB = Depends(get_current_user)) -> list[dict]:
+    """
+    Toggle up to BULK_MAX_ITEMS likes/dislikes in one request, applied in the request order:
+    - **reactions**: list of {"post_id": 1, "reaction": "like" | "dislike"}
+    - Return json with result for every reaction.
+    - Example:   [{"post_id": 1, "reaction": "like", "likes": value, "dislikes": value},
+    {"post_id": 2, "reaction": "dislike", "error": "Post not exists"}]
+    """
+    return await change_reactions_in_bulk(db=db, user=user, reactions=reactions.reactions)
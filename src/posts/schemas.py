@@ -1,4 +1,8 @@
-from pydantic import BaseModel, validator
+from typing import Literal
+
+from pydantic import BaseModel, Field, validator
+
+from config.base import settings
 
 
 class PostBase(BaseModel):
@@ -45,9 +49,31 @@ class PostInDB(PostBase):
         orm_mode = True
 
 
+class PostSummary(BaseModel):
+    """Пост в ленте без описания"""
+    id: int
+    title: str
+    likes: int | None
+    dislikes: int | None
+    author: int
+
+
 class Like(BaseModel):
     post_id: int
 
 
 class Dislike(BaseModel):
     post_id: int
+
+
+class PostsBulkCreate(BaseModel):
+    posts: list[PostCreate] = Field(..., min_items=1, max_items=settings.BULK_MAX_ITEMS)
+
+
+class ReactionToggle(BaseModel):
+    post_id: int
+    reaction: Literal['like', 'dislike']
+
+
+class ReactionsBulk(BaseModel):
+    reactions: list[ReactionToggle] = Field(..., min_items=1, max_items=settings.BULK_MAX_ITEMS)
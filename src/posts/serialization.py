@@ -0,0 +1,52 @@
+import struct
+import zlib
+
+from config.base import settings
+
+# Пост хранится в хэше post:{id} двумя бинарными полями: в горячем - то, что нужно ленте и проверкам
+# (айди, автор, заголовок, время загрузки из бд), в холодном - описание, сжатое если оно длинное.
+# Первый байт каждого поля - версия формата. Поле другой версии считается промахом кэша и перезаписывается из бд
+CACHE_FORMAT_VERSION = 1
+HOT_FIELD = 'h'
+COLD_FIELD = 'c'
+# Поля хэша в прежнем текстовом формате, удаляются при перезаписи поста
+LEGACY_FIELDS = ('id', 'title', 'description', 'author', 'delta')
+
+_HOT_HEADER = struct.Struct('>BQQI')  # версия, айди, автор, delta в мс
+_COLD_HEADER = struct.Struct('>BB')  # версия, флаги
+COMPRESSED = 0x01
+
+
+def pack_hot(post: dict, delta: int = 0) -> bytes:
+    return _HOT_HEADER.pack(CACHE_FORMAT_VERSION, post['id'], post['author'] or 0, delta) + post['title'].encode()
+
+
+def unpack_hot(data: bytes | None) -> dict | None:
+    """Айди, автор, заголовок и delta поста. Для отсутствующего поля или другой версии формата вернет None"""
+    if not data or data[0] != CACHE_FORMAT_VERSION:
+        return None
+    _, post_id, author, delta = _HOT_HEADER.unpack_from(data)
+    return {'id': post_id, 'title': data[_HOT_HEADER.size:].decode(), 'author': author, 'delta': delta}
+
+
+def pack_cold(description: str) -> bytes:
+    """Описание сжимается zlib, если оно длиннее CACHE_COMPRESS_MIN_BYTES и сжатие дает выигрыш"""
+    payload, flags = description.encode(), 0
+    if len(payload) >= settings.CACHE_COMPRESS_MIN_BYTES:
+        compressed = zlib.compress(payload, settings.CACHE_COMPRESS_LEVEL)
+        if len(compressed) < len(payload):
+            payload, flags = compressed, COMPRESSED
+    return _COLD_HEADER.pack(CACHE_FORMAT_VERSION, flags) + payload
+
+
+def unpack_cold(data: bytes | None) -> str | None:
+    if not data or data[0] != CACHE_FORMAT_VERSION:
+        return None
+    _, flags = _COLD_HEADER.unpack_from(data)
+    payload = data[_COLD_HEADER.size:]
+    return (zlib.decompress(payload) if flags & COMPRESSED else payload).decode()
+
+
+def post_cache_fields(post: dict, delta: int = 0) -> dict:
+    """Поля поста, которые хранятся в хэше кэша, delta - время загрузки поста из бд в мс"""
+    return {HOT_FIELD: pack_hot(post=post, delta=delta), COLD_FIELD: pack_cold(description=post['description'])}
@@ -1,24 +1,34 @@
 import logging
+import time
 from typing import Dict, Any
 
+from fastapi import HTTPException
 from fastapi.encoders import jsonable_encoder
 from redis.exceptions import RedisError
-from sqlalchemy import and_, text, delete
-from sqlalchemy.orm import Session
+from sqlalchemy import and_, bindparam, delete, func, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.exc import SQLAlchemyError
 from starlette.responses import JSONResponse
 
-from posts.models import Post, Likes, Dislikes
+from posts.models import Post, Likes, Dislikes, StaleCachedPost, StaleReaction
 from posts.schemas import PostCreate, PostUpdate
+from posts.local_cache import publish_post_invalidation
+from posts.serialization import post_cache_fields, unpack_hot, HOT_FIELD
+from posts.utils import post_key, reactors_key
 from users.models import User
 from users.schemas import UserInDB
 from config.base import manager
+from config.db import group_concat_ids
+from config.metrics import CACHE_FALLBACKS
 
 redis = manager.redis
+binary_redis = manager.binary_redis
 logger = logging.getLogger('app.posts.services')
 
+REACTIONS_COUNTERS = {Likes: Post.likes_count, Dislikes: Post.dislikes_count}
 
-def add_new_post_in_db(db: Session, obj_in: PostCreate, user: User) -> Post:
+
+async def add_new_post_in_db(db: AsyncSession, obj_in: PostCreate, user: User) -> Post:
     """Добавляет запись о новом посте"""
     obj_in = obj_in.dict()
     obj_in['author'] = user.id
@@ -26,15 +36,29 @@ def add_new_post_in_db(db: Session, obj_in: PostCreate, user: User) -> Post:
 
     try:
         db.add(db_obj)
-        db.commit()
+        await db.commit()
         return db_obj
     except SQLAlchemyError as err:
         logger.exception(err)
 
 
-def update_post(db: Session, post_id: int, obj_in: PostUpdate | Dict[str, Any]) -> Post:
+async def add_new_posts_in_db(db: AsyncSession, objs_in: list[PostCreate], user: User) -> list[Post]:
+    """Добавляет пачку новых постов одним коммитом"""
+    db_objs = [Post(**obj_in.dict(), author=user.id) for obj_in in objs_in]
+
+    try:
+        db.add_all(db_objs)
+        await db.commit()
+        return db_objs
+    except SQLAlchemyError as err:
+        logger.exception(err)
+        await db.rollback()
+        raise HTTPException(status_code=500, detail='Posts were not saved')
+
+
+async def update_post(db: AsyncSession, post_id: int, obj_in: PostUpdate | Dict[str, Any]) -> Post:
     """Апдейтит запись в бд у указанного поста. Если пост есть в кэше, то апдейтит данные и там"""
-    db_obj = db.query(Post).filter(Post.id == post_id).first()
+    db_obj = (await db.execute(select(Post).where(Post.id == post_id))).scalars().first()
     obj_data = jsonable_encoder(db_obj)
 
     if isinstance(obj_in, dict):
@@ -47,128 +71,189 @@ def update_post(db: Session, post_id: int, obj_in: PostUpdate | Dict[str, Any])
             setattr(db_obj, field, update_data[field])
     try:
         db.add(db_obj)
-        db.commit()
-        db.refresh(db_obj)
+        await db.commit()
+        await db.refresh(db_obj)
     except SQLAlchemyError as err:
         logger.exception(err)
 
     try:
-        if redis.hgetall(post_id):
-            redis.hset(post_id, mapping=update_data)
+        cached = unpack_hot(await binary_redis.hget(post_key(post_id), HOT_FIELD))
+        if cached:
+            post = {'id': db_obj.id, 'title': db_obj.title, 'description': db_obj.description, 'author': db_obj.author}
+            await binary_redis.hset(post_key(post_id), mapping=post_cache_fields(post=post, delta=cached['delta']))
     except RedisError as err:
         logger.error(err)
+        await mark_post_stale_in_cache(db=db, post_id=post_id)
+    await publish_post_invalidation(post_id)
 
     return db_obj
 
 
-def remove_post_from_db(db: Session, post_id: int) -> JSONResponse:
+async def remove_post_from_db(db: AsyncSession, post_id: int) -> JSONResponse:
     """Удаляет запись из бд и кэша"""
     try:
         obj = delete(Post).where(Post.id == post_id)
-        db.execute(obj)
-        db.commit()
+        await db.execute(obj)
+        await db.commit()
     except SQLAlchemyError as err:
         logger.exception(err)
 
     try:
-        redis.delete(post_id)
+        await redis.delete(post_key(post_id), reactors_key(post_id, 'like_user'),
+                           reactors_key(post_id, 'dislike_user'))
     except RedisError as err:
         logger.exception(err)
+        await mark_post_stale_in_cache(db=db, post_id=post_id)
+    await publish_post_invalidation(post_id)
 
     return JSONResponse(status_code=200, content={'Message': 'Post deleted'})
 
 
-def fetch_one_post(db: Session, post_id: int) -> dict | JSONResponse:
-    """Забирает и возвращает пост из бд по указанному айди"""
-    post_values = select_common_post_data(post_id=post_id, db=db)
-    like_user = select_all_users_with_likes(post_id=post_id, db=db)
-    dislike_user = select_all_users_with_dislikes(post_id=post_id, db=db)
-
-    if post_values:
-        pid, title, desc, author, dislikes, likes = list(post_values)
-        post = {"id": pid,
-                'title': title,
-                'description': desc,
-                'author': author,
-                'likes': likes,
-                'dislikes': dislikes,
-                'like_user': like_user,
-                'dislike_user': dislike_user}
-        return post
+async def fetch_one_post(db: AsyncSession, post_id: int) -> dict | JSONResponse:
+    """Забирает и возвращает пост из бд по указанному айди одним запросом вместе со счетчиками
+    и айдишниками юзеров, поставивших лайк/дизлайк"""
+    posts = await fetch_posts_by_ids(db=db, post_ids=[post_id])
+    if posts:
+        return posts[0]
     else:
         return JSONResponse(status_code=200, content={'Message': 'Post not exist'})
 
 
-def check_post_author(db: Session, post_id: int, user: UserInDB) -> bool:
+async def select_posts_ids_page(db: AsyncSession, limit: int, after_id: int | None = None,
+                                before_id: int | None = None, skip: int = 0) -> list[int]:
+    """Возвращает отсортированные по возрастанию айди постов для одной страницы ленты.
+    Страница выбирается по первичному ключу (after_id/before_id), поэтому ее стоимость не зависит от глубины.
+    skip оставлен для обратной совместимости и работает как обычный OFFSET"""
+    query = select(Post.id)
+    if after_id is not None:
+        query = query.where(Post.id > after_id)
+    if before_id is not None:
+        query = query.where(Post.id < before_id)
+
+    if before_id is not None and after_id is None:
+        post_ids = (await db.execute(query.order_by(Post.id.desc()).offset(skip).limit(limit))).scalars().all()
+        return list(reversed(post_ids))
+    return list((await db.execute(query.order_by(Post.id).offset(skip).limit(limit))).scalars().all())
+
+
+async def fetch_posts_by_ids(db: AsyncSession, post_ids: list[int]) -> list[dict]:
+    """Забирает из бд одним запросом посты по списку айди вместе со счетчиками лайков/дизлайков
+    и строками айдишников юзеров, которые их поставили. Несуществующие айди пропускаются"""
+    if not post_ids:
+        return []
+
+    rows = await db.execute(POSTS_BY_IDS_QUERY, {'post_ids': list(post_ids)})
+    return [post_from_row(row) for row in rows]
+
+
+def post_from_row(row) -> dict:
+    """Собирает словарь поста из строки результата POSTS_BY_IDS_QUERY"""
+    pid, title, desc, author, likes_count, dislikes_count, like_user, dislike_user = row
+    return {"id": pid,
+            'title': title,
+            'description': desc,
+            'author': author,
+            'likes': likes_count,
+            'dislikes': dislikes_count,
+            'like_user': like_user,
+            'dislike_user': dislike_user}
+
+
+def _select_emotions_by_posts(model: Likes | Dislikes):
+    """Подзапрос со склеенными через ':' айдишниками юзеров, поставивших лайк/дизлайк, по каждому посту"""
+    return (
+        select(model.post_id.label('post_id'),
+               group_concat_ids(model.user).label('users'))
+        .where(model.post_id.in_(bindparam('post_ids', expanding=True)))
+        .group_by(model.post_id)
+        .subquery()
+    )
+
+
+def _build_posts_by_ids_query():
+    """Запрос постов по списку айди (параметр post_ids) вместе со счетчиками и айдишниками юзеров,
+    поставивших лайк/дизлайк. Собирается один раз при импорте модуля"""
+    likes = _select_emotions_by_posts(model=Likes)
+    dislikes = _select_emotions_by_posts(model=Dislikes)
+    return (
+        select(Post.id, Post.title, Post.description, Post.author, Post.likes_count, Post.dislikes_count,
+               func.coalesce(likes.c.users, ''), func.coalesce(dislikes.c.users, ''))
+        .outerjoin(likes, likes.c.post_id == Post.id)
+        .outerjoin(dislikes, dislikes.c.post_id == Post.id)
+        .where(Post.id.in_(bindparam('post_ids', expanding=True)))
+    )
+
+
+POSTS_BY_IDS_QUERY = _build_posts_by_ids_query()
+
+
+async def check_post_author(db: AsyncSession, post_id: int, user: UserInDB) -> bool:
     """Проверка текущего юзера на авторство поста для лайка/дизлайка"""
-    owner = db.query(Post).filter(and_(Post.author == user.id, Post.id == post_id)).first()
+    owner = (await db.execute(select(Post.id).where(and_(Post.author == user.id, Post.id == post_id)))).first()
     if owner:
         return True
     else:
         return False
 
 
-def select_all_users_with_likes(post_id: int, db: Session) -> str:
-    """Возращает строку состоящую из айдишников юзеров, которые поставили лайки,
-    если таковых нет, то вернет пустую строку"""
-    list_of_users = db.query(Likes.user).filter(Likes.post_id == post_id).all()
-    ended_list = []
-    for user_id in list_of_users:
-        ended_list.append(str(user_id[0]))
-    if len(ended_list) > 0:
-        return ':'.join(ended_list)
-    else:
-        return ''
-
-
-def select_all_users_with_dislikes(post_id: int, db: Session) -> str:
-    """Возращает строку состоящую из айдишников юзеров, которые поставили дизлайки,
-    если таковых нет, то вернет пустую строку"""
-    list_of_users = db.query(Dislikes.user).filter(Dislikes.post_id == post_id).all()
-    ended_list = []
-    for user_id in list_of_users:
-        ended_list.append(str(user_id[0]))
-    if len(ended_list) > 0:
-        return ':'.join(ended_list)
-    else:
-        return ''
-
-
-def select_common_post_data(post_id: int, db: Session) -> list:
-    """Возвращает объединенные данные по посту со всех таблиц (Post,Likes,Dislikes)"""
-    query = text(f"""
-            SELECT posts.id as post_id, posts.title as title, posts.description, posts.author,
-            (SELECT COUNT(id) FROM dislikes WHERE post_id ={post_id}) as dislikes,
-            (SELECT count(id) FROM likes WHERE post_id={post_id}) as likes
-            from posts
-            where posts.id = {post_id}
-            group by posts.id""")
-    statement = db.execute(query)
-    for i in statement:
-        return i
-
-
-def change_emotions_in_db(post_id: int, db: Session, user: UserInDB, model: Likes | Dislikes) -> JSONResponse:
-    """ При падении редиса добавляет/удаляет данные напрямую в бд о лайках/дизлайках.
-    Возвращает код 201 и  количество лайков/дизлайков после изменения"""
-    db_emotions = db.query(model).where(model.post_id == post_id).all()
-    list_of_emotions_users_from_db = [i.user for i in db_emotions]
-    if user.id not in list_of_emotions_users_from_db:
-        obj_in = {'post_id': post_id, 'user': user.id}
-        db_obj = model(**obj_in)
-        try:
-            db.add(db_obj)
-            db.commit()
-        except SQLAlchemyError as err:
-            logger.exception(err)
-        emotions_value = db.query(model).filter(model.post_id == post_id).count()
-        return JSONResponse(status_code=201, content={model.__tablename__: emotions_value})
-    else:
-        try:
-            obj = delete(model).where(and_(model.post_id == post_id, model.user == user.id))
-            db.execute(obj)
-            db.commit()
-        except SQLAlchemyError as err:
-            logger.exception(err)
-        em_value = db.query(model).filter(model.post_id == post_id).count()
-        return JSONResponse(status_code=201, content={model.__tablename__: em_value})
+async def select_posts_authors(db: AsyncSession, post_ids: list[int]) -> dict[int, int]:
+    """Возвращает авторов постов одним запросом: айди поста -> айди автора. Несуществующие айди пропускаются"""
+    rows = await db.execute(select(Post.id, Post.author).where(Post.id.in_(set(post_ids))))
+    return {post_id: author for post_id, author in rows}
+
+
+async def change_emotions_in_db(post_id: int, db: AsyncSession, user: UserInDB,
+                                model: Likes | Dislikes) -> JSONResponse:
+    """ При падении редиса добавляет/удаляет данные напрямую в бд о лайках/дизлайках. При постановке реакции
+    противоположная снимается. Счетчики в таблице постов меняются в той же транзакции, там же пост помечается
+    для пересборки в кэше после восстановления редиса, а реакция - чтобы более ранние записи журнала
+    по ней не перезаписали это изменение.
+    Возвращает код 201 и количество лайков и дизлайков после изменения"""
+    opposite_model = Dislikes if model is Likes else Likes
+    counter, opposite_counter = REACTIONS_COUNTERS[model], REACTIONS_COUNTERS[opposite_model]
+    existing = (await db.execute(select(model.id).where(and_(model.post_id == post_id,
+                                                              model.user == user.id)))).first()
+    try:
+        if not existing:
+            db.add(model(post_id=post_id, user=user.id))
+            removed = await db.execute(delete(opposite_model).where(and_(opposite_model.post_id == post_id,
+                                                                           opposite_model.user == user.id)))
+            await db.execute(update(Post).where(Post.id == post_id).values(
+                {counter: counter + 1, opposite_counter: opposite_counter - removed.rowcount}))
+        else:
+            removed = await db.execute(delete(model).where(and_(model.post_id == post_id, model.user == user.id)))
+            await db.execute(update(Post).where(Post.id == post_id).values({counter: counter - removed.rowcount}))
+        await db.merge(StaleCachedPost(post_id=post_id))
+        await db.merge(StaleReaction(post_id=post_id, user=user.id, changed_at=int(time.time() * 1000)))
+        await db.commit()
+    except SQLAlchemyError as err:
+        logger.exception(err)
+        await db.rollback()
+    await publish_post_invalidation(post_id)
+
+    counts = (await db.execute(select(counter, opposite_counter).where(Post.id == post_id))).first()
+    emotions_value, opposite_value = counts if counts else (0, 0)
+    return JSONResponse(status_code=201, content={model.__tablename__: emotions_value,
+                                                  opposite_model.__tablename__: opposite_value})
+
+
+async def mark_post_stale_in_cache(db: AsyncSession, post_id: int) -> None:
+    """Помечает пост, который изменился в бд, но не обновился в кэше, для пересборки после восстановления редиса"""
+    CACHE_FALLBACKS.labels('mark_stale').inc()
+    try:
+        await db.merge(StaleCachedPost(post_id=post_id))
+        await db.commit()
+    except SQLAlchemyError as err:
+        logger.exception(err)
+        await db.rollback()
+
+
+def recount_reactions_counters(post_ids: list[int] | None = None):
+    """Возвращает UPDATE, который пересчитывает счетчики лайков/дизлайков постов по таблицам реакций.
+    Если айди не переданы, то пересчитываются все посты"""
+    likes = select(func.count(Likes.id)).where(Likes.post_id == Post.id).scalar_subquery()
+    dislikes = select(func.count(Dislikes.id)).where(Dislikes.post_id == Post.id).scalar_subquery()
+    statement = update(Post).values(likes_count=likes, dislikes_count=dislikes)
+    if post_ids is not None:
+        statement = statement.where(Post.id.in_(post_ids))
+    return statement
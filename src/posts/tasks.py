@@ -1,130 +1,272 @@
+import datetime
 import logging
+import time
+import uuid
 
 from celery import shared_task
-from sqlalchemy import and_
-from starlette.responses import JSONResponse
-from redis.exceptions import RedisError
+from sqlalchemy import delete, select, tuple_
+from redis.exceptions import RedisError, ResponseError
 from sqlalchemy.exc import SQLAlchemyError
 
-from posts.models import Likes, Dislikes
+from posts.models import Post, Likes, Dislikes, StaleCachedPost, StaleReaction
+from posts.services import recount_reactions_counters, post_from_row, POSTS_BY_IDS_QUERY
+from posts.local_cache import POSTS_INVALIDATION_CHANNEL
+from posts.serialization import post_cache_fields, LEGACY_FIELDS
+from posts.utils import (post_key, reactors_key, post_lock_key, collapse_journal_entries, apply_pending_reactions,
+                         REACTIONS_JOURNAL_KEY, REACTORS_FIELDS, POSTS_READS_KEY)
 from config.db import SessionLocal as db
 from config.base import settings
 from config.base import manager
 
-redis = manager.redis
+redis = manager.sync_redis
+binary_redis = manager.sync_binary_redis
 
 logger = logging.getLogger('app.posts.tasks')
 
+REACTIONS_JOURNAL_GROUP = 'db-sync'
+REACTIONS_JOURNAL_CONSUMER = 'db-sync'
+REACTIONS_JOURNAL_LOCK = f'{REACTIONS_JOURNAL_KEY}:lock'
+JOURNAL_MODELS = {'like_user': Likes, 'dislike_user': Dislikes}
 
-@shared_task(bind=True)
-def update_redis(self) -> None:
-    """Таска создается в случае если редис упал и запись лайков идет напрямую в бд.
-    Когда редис поднимется, кэш будет очищен."""
+# Удаляет лок, только если он все еще принадлежит тому, кто его ставил
+RELEASE_LOCK_LUA = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+release_lock_script = redis.register_script(RELEASE_LOCK_LUA)
+
+
+@shared_task(name='update_redis')
+def update_redis() -> None:
+    """Пока редис недоступен, изменения постов пишутся напрямую в бд, а сами посты помечаются.
+    Периодически проверяет такие пометки и, если редис снова доступен, переносит журнал лайков в бд,
+    сбрасывает в кэше только помеченные посты, пересобирает те из них, что были в кэше,
+    и прогревает самые читаемые посты"""
+    stale_ids = select_stale_post_ids()
+    if not stale_ids:
+        return
+
+    try:
+        redis.ping()
+        update_db()
+        rebuilt = 0
+        while stale_ids:
+            rebuilt += warm_up_posts(post_ids=invalidate_cached_posts(post_ids=stale_ids))
+            db.execute(delete(StaleCachedPost).where(StaleCachedPost.post_id.in_(stale_ids)))
+            db.commit()
+            stale_ids = select_stale_post_ids()
+        warmed = warm_up_posts(post_ids=select_most_read_post_ids())
+        logger.info(f'CACHE RECOVERED, {rebuilt} stale posts rebuilt, {warmed} most read posts warmed up')
+    except RedisError as err:
+        logger.error(err)
+    except SQLAlchemyError as err:
+        logger.exception(err)
+        db.rollback()
+
+
+def select_stale_post_ids() -> list[int]:
+    """Возвращает пачку айди постов, которые менялись в бд, пока редис был недоступен"""
+    return list(db.execute(select(StaleCachedPost.post_id).limit(settings.CACHE_PREWARM_BATCH_SIZE)).scalars())
+
+
+def invalidate_cached_posts(post_ids: list[int]) -> list[int]:
+    """Удаляет посты из кэша и сбрасывает их в локальных кэшах воркеров.
+    Возвращает айди постов, которые были в кэше"""
+    pipe = redis.pipeline(transaction=False)
+    for post_id in post_ids:
+        pipe.delete(post_key(post_id), *(reactors_key(post_id, users) for users in REACTORS_FIELDS))
+        pipe.publish(POSTS_INVALIDATION_CHANNEL, post_id)
+    replies = pipe.execute()
+    return [post_id for i, post_id in enumerate(post_ids) if replies[i * 2]]
+
+
+@shared_task(name='decay_posts_reads')
+def decay_posts_reads() -> None:
+    """Уменьшает рейтинг читаемости в POSTS_READS_DECAY раз и оставляет в нем POSTS_READS_MAX_ITEMS постов,
+    чтобы для прогрева выбирались посты, которые читают сейчас, а не за все время"""
     try:
-        redis.flushdb()
+        pipe = redis.pipeline(transaction=True)
+        pipe.zunionstore(POSTS_READS_KEY, {POSTS_READS_KEY: settings.POSTS_READS_DECAY})
+        pipe.zremrangebyrank(POSTS_READS_KEY, 0, -settings.POSTS_READS_MAX_ITEMS - 1)
+        pipe.execute()
     except RedisError as err:
-        raise self.retry(exc=err, max_retries=5, countdown=5)
+        logger.error(err)
+
+
+def select_most_read_post_ids() -> list[int]:
+    """Возвращает айди самых читаемых постов. Если рейтинг читаемости потерян вместе с данными редиса,
+    то вернет айди самых новых постов"""
+    post_ids = [int(post_id) for post_id in redis.zrevrange(POSTS_READS_KEY, 0, settings.CACHE_PREWARM_TOP_N - 1)]
+    if post_ids:
+        return post_ids
+    return list(db.execute(select(Post.id).order_by(Post.id.desc()).limit(settings.CACHE_PREWARM_TOP_N)).scalars())
+
+
+def warm_up_posts(post_ids: list[int]) -> int:
+    """Пачками кладет в кэш посты, которых там нет. Возвращает количество добавленных постов"""
+    warmed = 0
+    for i in range(0, len(post_ids), settings.CACHE_PREWARM_BATCH_SIZE):
+        warmed += warm_up_posts_batch(post_ids=post_ids[i:i + settings.CACHE_PREWARM_BATCH_SIZE])
+    return warmed
+
+
+def warm_up_posts_batch(post_ids: list[int]) -> int:
+    """Берет те же локи на загрузку, что и воркеры апи, и одним запросом к бд загружает посты, которых нет в кэше.
+    На реакции из бд накладываются записи журнала, которые еще не перенесены в бд. Посты записываются в кэш
+    одной транзакцией, чтобы между записью хэша и множеств в пост не попала реакция, которой нет в бд"""
+    token = uuid.uuid4().hex
+    pipe = redis.pipeline(transaction=False)
+    for post_id in post_ids:
+        pipe.set(post_lock_key(post_id), token, nx=True, px=settings.CACHE_LOCK_TIMEOUT)
+        pipe.exists(post_key(post_id))
+    replies = pipe.execute()
+    locked_ids = [post_id for i, post_id in enumerate(post_ids) if replies[i * 2]]
+    ids_to_load = [post_id for i, post_id in enumerate(post_ids) if replies[i * 2] and not replies[i * 2 + 1]]
+
+    try:
+        if not ids_to_load:
+            return 0
+        # Журнал читается до бд: записи, перенесенные между чтениями, применятся повторно с тем же итогом
+        pending = redis.xrange(REACTIONS_JOURNAL_KEY)
+        started = time.perf_counter()
+        posts = [post_from_row(row) for row in db.execute(POSTS_BY_IDS_QUERY, {'post_ids': ids_to_load})]
+        apply_pending_reactions(posts=posts, entries=pending)
+        delta = max(int((time.perf_counter() - started) * 1000), 1)
+
+        ttl = datetime.timedelta(hours=settings.TTL)
+        pipe = binary_redis.pipeline(transaction=True)
+        for post in posts:
+            pipe.hdel(post_key(post['id']), *LEGACY_FIELDS)
+            pipe.hset(post_key(post['id']), mapping=post_cache_fields(post=post, delta=delta))
+            pipe.expire(post_key(post['id']), time=ttl)
+            for users in REACTORS_FIELDS:
+                key = reactors_key(post['id'], users)
+                pipe.delete(key)
+                if post[users]:
+                    pipe.sadd(key, *post[users].split(':'))
+                    pipe.expire(key, time=ttl)
+        pipe.execute()
+        return len(posts)
+    finally:
+        pipe = redis.pipeline(transaction=False)
+        for post_id in locked_ids:
+            release_lock_script(keys=[post_lock_key(post_id)], args=[token], client=pipe)
+        pipe.execute()
 
 
 @shared_task(name='update_db')
 def update_db() -> None:
-    """Запускается раз в сутки и синхронизирует данные по лайкам/дизлайкам с основной бд"""
-    all_keys = get_all_keys_from_cache()
-    posts_for_update = get_posts_for_update(all_keys=all_keys)
-    update_post_with_like(posts_for_update=posts_for_update)
-    update_post_dislike(posts_for_update=posts_for_update)
-    logger.info('DB UPDATED')
-
-
-def get_all_keys_from_cache() -> list:
-    """Возвращает список всех ключей из кэша"""
-    status = None
-    redis_curs = 0
-    all_kyes_from_cache = []
-    while status is None:
-        redis_list = redis.scan(redis_curs)
-        if redis_list[0] != 0:
-            all_kyes_from_cache += redis_list[1]
-            redis_curs = redis_list[0]
-        else:
-            all_kyes_from_cache += redis_list[1]
-            status = True
-    if len(all_kyes_from_cache) == 0:
-        return JSONResponse(status_code=201, content={'msg': 'No posts in cache'})
-    else:
-        return all_kyes_from_cache
-
-
-def get_posts_for_update(all_keys: list) -> dict:
-    """Возвращает словарь. Ключи - айдишники тех постов, что нужно обновить в БД.
-    Логика обновления - если текущий TLL записи в кэше больше разницы (текущий - дневной),
-    то пост добавляется для обновления."""
-    posts_for_update = {}
-    for item in all_keys:
-        timer = redis.ttl(item)
-        if timer > settings.TTL - settings.DAY_SECONDS:
-            request_post = redis.hgetall(item)
-            check_for_like_users = request_post['like_user'].split(':')
-            check_for_dislike_users = request_post['dislike_user'].split(':')
-
-            if len(check_for_like_users) == 1 and not check_for_like_users[0].isdigit():
-                check_for_like_users.remove("")
-
-            if len(check_for_dislike_users) == 1 and not check_for_dislike_users[0].isdigit():
-                check_for_dislike_users.remove("")
-
-            posts_for_update[item] = {'like_user': list(map(int, check_for_like_users)),
-                                      'dislike_user': list(map(int, check_for_dislike_users))}
-        else:
-            continue
-    return posts_for_update
-
-
-def update_post_with_like(posts_for_update: dict) -> None:
-    """Вычисляет пересечение user.id  поста межу кэшем и бд.
-    Добавляет в бд тех кто есть в кэше, но нет в бд, удаляет тех кто есть в бд, но нет в кэше"""
-    for post_id in posts_for_update:
-        db_likes = db.query(Likes).where(Likes.post_id == post_id).all()
-        list_of_likes_users_from_db = [i.user for i in db_likes]
-        like_list_for_delete = list(set(list_of_likes_users_from_db) - set(posts_for_update[post_id]['like_user']))
-        like_list_for_add = list(set(posts_for_update[post_id]['like_user']) - set(list_of_likes_users_from_db))
-        try:
-            if len(like_list_for_delete) != 0:
-                db.query(Likes).where(
-                    and_(Likes.user.in_(like_list_for_delete), Likes.post_id == int(post_id))).delete()
-                db.commit()
-
-            if len(like_list_for_add) != 0:
-                db.execute(
-                    Likes.__table__.insert(),
-                    [{"post_id": int(post_id), "user": user} for user in like_list_for_add]
-                )
-                db.commit()
-        except SQLAlchemyError as err:
-            logger.exception(err)
-
-
-def update_post_dislike(posts_for_update: dict) -> None:
-    """Вычисляет пересечение user.id  поста межу кэшем и бд.
-    Добавляет в бд тех кто есть в кэше, но нет в бд, удаляет тех кто есть в бд, но нет в кэше"""
-    for post_id in posts_for_update:
-        db_dislikes = db.query(Dislikes).where(Dislikes.post_id == post_id).all()
-        list_of_dislikes_users_from_db = [i.user for i in db_dislikes]
-        dislike_list_for_delete = list(
-            set(list_of_dislikes_users_from_db) - set(posts_for_update[post_id]['dislike_user']))
-        dislike_list_for_add = list(
-            set(posts_for_update[post_id]['dislike_user']) - set(list_of_dislikes_users_from_db))
-        try:
-            if len(dislike_list_for_delete) != 0:
-                db.query(Dislikes).where(
-                    and_(Dislikes.user.in_(dislike_list_for_delete), Dislikes.post_id == int(post_id))).delete()
-                db.commit()
-
-            if len(dislike_list_for_add) != 0:
-                db.execute(
-                    Dislikes.__table__.insert(),
-                    [{"post_id": post_id, "user": user} for user in dislike_list_for_add]
-                )
-                db.commit()
-        except SQLAlchemyError as err:
-            logger.exception(err)
+    """Каждые несколько секунд вычитывает журнал лайков/дизлайков из redis stream и пачками переносит
+    изменения в основную бд. Затрагиваются только те посты, по которым были изменения.
+    Записи, перекрытые реакциями из бд за время недоступности редиса, пропускаются"""
+    lock = redis.lock(REACTIONS_JOURNAL_LOCK, timeout=settings.REACTIONS_FLUSH_LOCK_TIMEOUT, blocking=False)
+    if not lock.acquire():
+        return
+
+    try:
+        create_journal_group()
+        started = int(time.time() * 1000)
+        flushed, drained = 0, False
+        for _ in range(settings.REACTIONS_FLUSH_MAX_BATCHES):
+            entries = read_journal_batch()
+            if not entries:
+                drained = True
+                break
+            reactions = collapse_journal_entries(entries=skip_superseded_entries(entries=entries))
+            if reactions:
+                apply_reactions_to_db(reactions=reactions)
+            else:
+                db.rollback()
+            ack_journal_entries(entry_ids=[entry_id for entry_id, _ in entries])
+            flushed += len(entries)
+        if drained:
+            delete_stale_reactions(before=started)
+        if flushed:
+            logger.info(f'DB UPDATED, {flushed} reactions flushed')
+    finally:
+        lock.release()
+
+
+def create_journal_group() -> None:
+    """Создает группу консьюмеров журнала, если ее еще нет"""
+    try:
+        redis.xgroup_create(REACTIONS_JOURNAL_KEY, REACTIONS_JOURNAL_GROUP, id='0', mkstream=True)
+    except ResponseError as err:
+        if 'BUSYGROUP' not in str(err):
+            raise
+
+
+def read_journal_batch() -> list:
+    """Возвращает пачку записей журнала. Сначала отдаются записи, которые были прочитаны,
+    но не подтверждены (например воркер упал посреди переноса), затем новые"""
+    for last_id in ('0', '>'):
+        response = redis.xreadgroup(REACTIONS_JOURNAL_GROUP, REACTIONS_JOURNAL_CONSUMER,
+                                    {REACTIONS_JOURNAL_KEY: last_id}, count=settings.REACTIONS_FLUSH_BATCH_SIZE)
+        entries = response[0][1] if response else []
+        if entries:
+            return entries
+    return []
+
+
+def skip_superseded_entries(entries: list) -> list:
+    """Убирает записи журнала, сделанные раньше, чем та же реакция была изменена напрямую в бд
+    при недоступном редисе. Время записи берется из ее айди в stream"""
+    pairs = {(int(entry['post_id']), int(entry['user'])) for _, entry in entries}
+    changed_at = {(post_id, user): changed for post_id, user, changed in db.execute(
+        select(StaleReaction.post_id, StaleReaction.user, StaleReaction.changed_at)
+        .where(tuple_(StaleReaction.post_id, StaleReaction.user).in_(pairs)))}
+    if not changed_at:
+        return entries
+    return [(entry_id, entry) for entry_id, entry in entries
+            if int(entry_id.split('-')[0]) >= changed_at.get((int(entry['post_id']), int(entry['user'])), 0)]
+
+
+def delete_stale_reactions(before: int) -> None:
+    """Удаляет пометки реакций, измененных в бд раньше before (мс). Журнал к этому моменту вычитан до конца,
+    а новые записи в нем будут позже пометок"""
+    try:
+        db.execute(delete(StaleReaction).where(StaleReaction.changed_at < before))
+        db.commit()
+    except SQLAlchemyError as err:
+        logger.exception(err)
+        db.rollback()
+
+
+def apply_reactions_to_db(reactions: dict) -> None:
+    """Переносит итоговое состояние реакций в бд: по одному удалению и одной вставке на таблицу,
+    затем в той же транзакции пересчитывает счетчики у затронутых постов"""
+    post_ids = {post_id for _, post_id, _ in reactions}
+    existing_posts = set(db.execute(select(Post.id).where(Post.id.in_(post_ids))).scalars())
+    try:
+        for reaction, model in JOURNAL_MODELS.items():
+            to_add = [(post_id, user) for (field, post_id, user), added in reactions.items()
+                      if field == reaction and added and post_id in existing_posts]
+            to_delete = [(post_id, user) for (field, post_id, user), added in reactions.items()
+                         if field == reaction and not added]
+
+            if to_delete:
+                db.execute(delete(model).where(tuple_(model.post_id, model.user).in_(to_delete)))
+
+            if to_add:
+                already_in_db = set(db.execute(
+                    select(model.post_id, model.user).where(tuple_(model.post_id, model.user).in_(to_add))).all())
+                rows = [{'post_id': post_id, 'user': user} for post_id, user in to_add
+                        if (post_id, user) not in already_in_db]
+                if rows:
+                    db.execute(model.__table__.insert(), rows)
+        db.execute(recount_reactions_counters(post_ids=list(post_ids)))
+        db.commit()
+    except SQLAlchemyError as err:
+        logger.exception(err)
+        db.rollback()
+        raise
+
+
+def ack_journal_entries(entry_ids: list) -> None:
+    """Подтверждает перенесенные записи и удаляет их из журнала"""
+    pipe = redis.pipeline(transaction=False)
+    pipe.xack(REACTIONS_JOURNAL_KEY, REACTIONS_JOURNAL_GROUP, *entry_ids)
+    pipe.xdel(REACTIONS_JOURNAL_KEY, *entry_ids)
+    pipe.execute()
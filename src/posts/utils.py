@@ -0,0 +1,71 @@
+import base64
+import binascii
+import json
+
+from fastapi import HTTPException
+
+# Redis stream, в который пишется каждое изменение лайков/дизлайков для переноса в бд
+REACTIONS_JOURNAL_KEY = 'reactions:journal'
+# Sorted set с количеством чтений постов из редиса, по нему прогреваются самые читаемые посты
+POSTS_READS_KEY = 'posts:reads'
+REACTORS_FIELDS = ('like_user', 'dislike_user')
+REACTORS_COUNTERS = {'like_user': 'likes', 'dislike_user': 'dislikes'}
+
+
+def encode_cursor(after_id: int | None = None, before_id: int | None = None) -> str:
+    """Упаковывает позицию в ленте в непрозрачный для клиента токен"""
+    position = {'after_id': after_id} if after_id is not None else {'before_id': before_id}
+    return base64.urlsafe_b64encode(json.dumps(position).encode()).decode()
+
+
+def decode_cursor(cursor: str) -> tuple[int | None, int | None]:
+    """Распаковывает токен курсора в пару (after_id, before_id). Если токен битый, то вернет код 400"""
+    try:
+        position = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        after_id, before_id = position.get('after_id'), position.get('before_id')
+        if not all(value is None or isinstance(value, int) for value in (after_id, before_id)):
+            raise ValueError
+    except (ValueError, AttributeError, binascii.Error):
+        raise HTTPException(status_code=400, detail='Invalid cursor')
+    return after_id, before_id
+
+
+def post_key(post_id: int | str) -> str:
+    """Ключ хэша с данными поста в кэше"""
+    return f'post:{post_id}'
+
+
+def reactors_key(post_id: int | str, users: str) -> str:
+    """Ключ множества айдишников юзеров, поставивших лайк (users='like_user') или дизлайк (users='dislike_user')"""
+    return f'post:{post_id}:{users}'
+
+
+def post_lock_key(post_id: int | str) -> str:
+    """Ключ короткого лока на загрузку поста из бд в кэш"""
+    return f'post:{post_id}:lock'
+
+
+def collapse_journal_entries(entries: list) -> dict:
+    """Схлопывает записи журнала до итогового состояния. Возвращает словарь
+    {(поле реакции, айди поста, айди юзера): True если реакция стоит, False если снята}"""
+    reactions = {}
+    for _, entry in entries:
+        reactions[(entry['reaction'], int(entry['post_id']), int(entry['user']))] = entry['op'] == 'add'
+    return reactions
+
+
+def apply_pending_reactions(posts: list[dict], entries: list) -> None:
+    """Накладывает на айдишники юзеров, поставивших лайк/дизлайк постам из бд, записи журнала,
+    которые еще не перенесены в бд, и пересчитывает по ним счетчики"""
+    posts_by_id = {post['id']: post for post in posts}
+    for (users, post_id, user), added in collapse_journal_entries(entries=entries).items():
+        post = posts_by_id.get(post_id)
+        if post is None:
+            continue
+        reactors = set(post[users].split(':')) if post[users] else set()
+        if added:
+            reactors.add(str(user))
+        else:
+            reactors.discard(str(user))
+        post[users] = ':'.join(reactors)
+        post[REACTORS_COUNTERS[users]] = len(reactors)
@@ -0,0 +1,148 @@
+import logging
+
+from fastapi import HTTPException, status
+from pydantic import ValidationError
+from redis.exceptions import RedisError
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from config.base import manager, settings
+from config.invalidation import register_invalidation_channel
+from config.lru import LRUCache
+from users.models import User
+from users.schemas import UserPrincipal
+
+redis = manager.redis
+logger = logging.getLogger('app.users.cache')
+
+# Канал, в который публикуются логины измененных юзеров, чтобы остальные воркеры сбросили их из локального кэша
+USERS_INVALIDATION_CHANNEL = 'users:invalidate'
+
+local_users_cache = LRUCache(name='users', max_items=settings.USER_LOCAL_CACHE_MAX_ITEMS,
+                             max_bytes=settings.LOCAL_CACHE_MAX_BYTES, ttl=settings.USER_LOCAL_CACHE_TTL)
+register_invalidation_channel(USERS_INVALIDATION_CHANNEL, local_users_cache)
+
+
+def user_key(username: str) -> str:
+    """Ключ хэша с данными юзера в кэше"""
+    return f'user:{username}'
+
+
+def unknown_login_key(username: str) -> str:
+    """Ключ-пометка, что юзера с таким логином нет"""
+    return f'login:unknown:{username}'
+
+
+def login_failures_key(username: str) -> str:
+    """Счетчик неверных паролей подряд для логина"""
+    return f'login:failures:{username}'
+
+
+async def get_user_principal(db: AsyncSession, username: str) -> UserPrincipal | None:
+    """Возвращает айди, логин, емейл и статус юзера по логину из токена. Сначала ищет в локальном кэше воркера,
+    затем в редисе (короткий ttl), и только потом идет в бд. Если юзера нет, то вернет None"""
+    principal = local_users_cache.get(username)
+    if principal:
+        return principal
+
+    try:
+        cached = await redis.hgetall(user_key(username))
+        if cached:
+            principal = UserPrincipal(**cached)
+            local_users_cache.set(username, principal)
+            return principal
+    except RedisError as err:
+        logger.error(err)
+    except ValidationError:
+        # Запись в старом формате (например без статуса) считается промахом и перезаписывается из бд
+        await _delete_cached_principal(username)
+
+    row = (await db.execute(select(User.id, User.username, User.email, User.status)
+                            .where(User.username == username))).first()
+    if row is None:
+        return None
+    principal = UserPrincipal(id=row.id, username=row.username, email=row.email, status=row.status)
+    local_users_cache.set(username, principal)
+    try:
+        pipe = redis.pipeline(transaction=False)
+        pipe.hset(user_key(username), mapping=principal.dict())
+        pipe.expire(user_key(username), settings.USER_CACHE_TTL)
+        await pipe.execute()
+    except RedisError as err:
+        logger.error(err)
+    return principal
+
+
+def add_principal_invalidation(pipe, username: str) -> None:
+    """Добавляет в пайплайн (синхронный или асинхронный) удаление данных юзера из редиса
+    и оповещение воркеров апи, чтобы они сбросили его из локального кэша"""
+    pipe.delete(user_key(username))
+    pipe.publish(USERS_INVALIDATION_CHANNEL, username)
+
+
+async def _delete_cached_principal(username: str) -> None:
+    try:
+        await redis.delete(user_key(username))
+    except RedisError as err:
+        logger.error(err)
+
+
+async def invalidate_user_principal(username: str) -> None:
+    """Сбрасывает данные юзера из кэшей после их изменения в бд"""
+    local_users_cache.invalidate(username)
+    try:
+        pipe = redis.pipeline(transaction=False)
+        add_principal_invalidation(pipe, username)
+        await pipe.execute()
+    except RedisError as err:
+        logger.error(err)
+
+
+async def check_login_allowed(username: str) -> None:
+    """Отсекает попытки входа без обращения к бд и bcrypt: для логина, про который известно, что его нет,
+    вернет код 401, а после LOGIN_MAX_FAILURES неверных паролей подряд - код 429.
+    Если редис недоступен, то проверка пропускается"""
+    try:
+        unknown, failures = await redis.mget(unknown_login_key(username), login_failures_key(username))
+    except RedisError as err:
+        logger.error(err)
+        return
+
+    if unknown:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail='Bad credentials')
+    if failures and int(failures) >= settings.LOGIN_MAX_FAILURES:
+        raise HTTPException(status_code=status.HTTP_429_TOO_MANY_REQUESTS, detail='Too many login attempts',
+                            headers={'Retry-After': str(settings.LOGIN_FAILURES_WINDOW)})
+
+
+async def remember_unknown_login(username: str) -> None:
+    try:
+        await redis.set(unknown_login_key(username), 1, ex=settings.LOGIN_UNKNOWN_USER_TTL)
+    except RedisError as err:
+        logger.error(err)
+
+
+async def forget_unknown_login(username: str) -> None:
+    """Снимает пометку несуществующего логина, когда юзер с таким логином регистрируется"""
+    try:
+        await redis.delete(unknown_login_key(username))
+    except RedisError as err:
+        logger.error(err)
+
+
+async def register_login_failure(username: str) -> None:
+    """Увеличивает счетчик неверных паролей, окно блокировки отсчитывается от первой ошибки"""
+    try:
+        pipe = redis.pipeline(transaction=False)
+        pipe.incr(login_failures_key(username))
+        pipe.expire(login_failures_key(username), settings.LOGIN_FAILURES_WINDOW, nx=True)
+        await pipe.execute()
+    except RedisError as err:
+        logger.error(err)
+
+
+async def reset_login_failures(username: str) -> None:
+    try:
+        await redis.delete(login_failures_key(username))
+    except RedisError as err:
+        logger.error(err)
@@ -7,6 +7,11 @@ from config.db import Base
 
 logger = logging.getLogger('app.db.models')
 
+# Статусы аккаунта: pending - ждет проверки hunter/clearbit, active - проверен, flagged - не прошел проверку
+USER_STATUS_PENDING = 'pending'
+USER_STATUS_ACTIVE = 'active'
+USER_STATUS_FLAGGED = 'flagged'
+
 
 class User(Base):
     __tablename__ = "users"
@@ -15,6 +20,7 @@ class User(Base):
     username = Column(String, unique=True, nullable=False)
     email = Column(String, unique=True, nullable=False)
     hashed_password = Column(String)
+    status = Column(String(16), nullable=False, default=USER_STATUS_ACTIVE, server_default=USER_STATUS_ACTIVE)
 
     post = relationship("Post", backref="user", passive_deletes=True)
     like = relationship('Likes', backref='author', passive_deletes=True)
@@ -0,0 +1,68 @@
+import asyncio
+import logging
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from fastapi import HTTPException, status
+from passlib.context import CryptContext
+
+from config.base import settings
+from config.metrics import PASSWORD_HASHING_DURATION
+
+logger = logging.getLogger('app.users.passwords')
+
+# Хэши с другим количеством раундов считаются устаревшими и пересчитываются при следующем входе
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=settings.BCRYPT_ROUNDS)
+
+_executor: ProcessPoolExecutor | None = None
+_pending = 0
+
+
+def _hash(password: str) -> str:
+    return pwd_context.hash(password)
+
+
+def _verify_and_update(password: str, hashed_password: str) -> tuple[bool, str | None]:
+    return pwd_context.verify_and_update(password, hashed_password)
+
+
+def _get_executor() -> ProcessPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(max_workers=settings.PASSWORD_HASHING_WORKERS)
+    return _executor
+
+
+async def _run_in_pool(operation: str, func, *args):
+    """Выполняет bcrypt в отдельном пуле процессов, чтобы не занимать event loop и GIL воркера апи.
+    Если в очереди уже PASSWORD_HASHING_MAX_PENDING задач, то сразу вернет код 503"""
+    global _pending
+    if _pending >= settings.PASSWORD_HASHING_MAX_PENDING:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail='Too many requests, try later',
+                            headers={'Retry-After': '1'})
+    _pending += 1
+    started = time.perf_counter()
+    try:
+        return await asyncio.get_running_loop().run_in_executor(_get_executor(), func, *args)
+    finally:
+        _pending -= 1
+        PASSWORD_HASHING_DURATION.labels(operation).observe(time.perf_counter() - started)
+
+
+async def hash_password(password: str) -> str:
+    """Хэширует пароль с текущим количеством раундов bcrypt"""
+    return await _run_in_pool('hash', _hash, password)
+
+
+async def verify_password(password: str, hashed_password: str) -> tuple[bool, str | None]:
+    """Проверяет пароль. Если пароль верный, но хэш посчитан с устаревшими параметрами,
+    то вторым значением вернет новый хэш, который надо сохранить в бд"""
+    return await _run_in_pool('verify', _verify_and_update, password, hashed_password)
+
+
+async def shutdown_password_hashing() -> None:
+    """Останавливает пул процессов при остановке приложения"""
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
@@ -1,42 +1,41 @@
 import fastapi
-from fastapi import Depends, HTTPException, Request
+from fastapi import Depends, Request
 from fastapi.security import OAuth2PasswordRequestForm
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 from starlette import status
 
 from config.db import get_db
 from users.models import User
-from users.schemas import UserInDB, UserCreate, Token
-from users.services import add_new_user_in_db, fetch_user_from_db
-from users.utils import verify_user_password, create_token
+from users.schemas import UserInDB, UserCreate, Token, UserStatus, UserPrincipal
+from users.services import add_new_user_in_db, authenticate_user
+from users.utils import get_current_principal
 
 user_router = fastapi.APIRouter()
 
 
 @user_router.post("/singup", response_model=UserInDB, status_code=status.HTTP_201_CREATED)
-async def create_user(request: Request, obj_in: UserCreate, db: Session = Depends(get_db)) -> User:
+async def create_user(request: Request, obj_in: UserCreate, db: AsyncSession = Depends(get_db)) -> User:
     """
     Create new users:
     - **username**: Username must contain only [a-z] or/and [A-Z] or/and [0-9] and length between 4-15.
     - **password**:Password must contain at least 1 character [A-Z and 0-9] and min length 8 characters.
     - **email**: Must be valid
     - username and email **must be unique**
+    - with async verification enabled the account is created with status **pending**, see /status
     """
     new_user = await add_new_user_in_db(db=db, obj_in=obj_in, request=request)
     return new_user
 
 
 @user_router.post('/login', response_model=Token, status_code=status.HTTP_200_OK)
-def login(db: Session = Depends(get_db), form_data: OAuth2PasswordRequestForm = Depends()) -> dict:
-    username = fetch_user_from_db(db, form_data)
-    if not username:
-        raise HTTPException(status_code=401, detail='Bad credentials')
-
-    user_password = verify_user_password(db=db, user_credentials=form_data)
-    if not user_password:
-        raise HTTPException(status_code=401, detail='Bad credentials')
-
-    return {
-        "access_token": create_token(sub=form_data.username),
-        "token_type": "bearer"
-    }
+async def login(db: AsyncSession = Depends(get_db), form_data: OAuth2PasswordRequestForm = Depends()) -> dict:
+    return await authenticate_user(db=db, username=form_data.username, password=form_data.password)
+
+
+@user_router.get('/status', response_model=UserStatus, status_code=status.HTTP_200_OK)
+async def get_user_status(user: UserPrincipal = Depends(get_current_principal)) -> UserPrincipal:
+    """
+    - Return status of the current account: **pending** (email/risk checks are running), **active** or **flagged**.
+    - Example:   {"username": "string", "status": "active"}
+    """
+    return user
@@ -33,10 +33,25 @@ class UserCreate(UserBase):
 
 
 class UserInDB(UserBase):
+    status: str | None
+
     class Config:
         orm_mode = True
 
 
+class UserPrincipal(UserBase):
+    id: int
+    status: str
+
+    class Config:
+        orm_mode = True
+
+
+class UserStatus(BaseModel):
+    username: str
+    status: str
+
+
 class Token(BaseModel):
     access_token: str
     token_type: str
@@ -44,3 +59,4 @@ class Token(BaseModel):
 
 class TokenData(BaseModel):
     username: str | None
+    id: int | None
@@ -1,63 +1,121 @@
+import asyncio
 import logging
 
-from fastapi import HTTPException, Request
+from fastapi import HTTPException, Request, status
 from sqlalchemy import or_, select
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.exc import SQLAlchemyError
 
-from users.models import User
+from users.models import User, USER_STATUS_PENDING, USER_STATUS_ACTIVE, USER_STATUS_FLAGGED
 from users.schemas import UserCreate
-from users.utils import create_hashed_user_password
+from users.cache import (check_login_allowed, remember_unknown_login, forget_unknown_login, register_login_failure,
+                         reset_login_failures, invalidate_user_principal)
+from users.passwords import verify_password
+from users.utils import create_hashed_user_password, create_token, update_user_hashed_password
 from users.validators import clearbit_new_user_score_checker, hunter_user_email_checker
+from config.base import settings
 
 logger = logging.getLogger('app.users.services')
 
 
-async def add_new_user_in_db(db: Session, obj_in: UserCreate, request: Request) -> User:
+async def add_new_user_in_db(db: AsyncSession, obj_in: UserCreate, request: Request) -> User:
     """Добавляет новую запись в БД при регистрации пользователя. Если проверка на уникальность логина или емайла не
     проходит, то возвращает код 400 и описание проблемы. Если от clearbit приходит высокий score,
     предполагается логика с капчей и подтверждением емейла,
-    но в данной версии эта фича(капча и подтверждение емейла) не реализована еще."""
-    clearbit_user_score = await clearbit_new_user_score_checker(user_data=obj_in, request=request)
-    hunter_status_score = await hunter_user_email_checker(user_data=obj_in)
-    user_in_db = user_uniqueness_check(db=db, user_data=obj_in)
-
-    if not user_in_db and clearbit_user_score != 'high' and not hunter_status_score:
-        new_data = obj_in.dict()
-        new_data.pop('password')
-        db_obj = User(**new_data)
-        db_obj.hashed_password = create_hashed_user_password(obj_in.password)
-        try:
-            db.add(db_obj)
-            db.commit()
-            return db_obj
-        except SQLAlchemyError as err:
-            logger.exception(err)
+    но в данной версии эта фича(капча и подтверждение емейла) не реализована еще.
+    Уникальность проверяется до обращения к внешним сервисам, а сами сервисы опрашиваются одновременно.
+    При включенной SIGNUP_ASYNC_VERIFICATION аккаунт сразу создается в статусе pending,
+    а проверки выполняет celery таска"""
+    user_in_db = await user_uniqueness_check(db=db, user_data=obj_in)
+    if user_in_db:
+        if user_in_db.username == obj_in.username:
+            raise HTTPException(status_code=400, detail='Username already exists')
+        raise HTTPException(status_code=400, detail='Email already exists')
+
+    if settings.SIGNUP_ASYNC_VERIFICATION:
+        db_obj = await save_new_user(db=db, obj_in=obj_in, user_status=USER_STATUS_PENDING)
+        enqueue_users_verification()
+        return db_obj
+
+    clearbit_user_score, hunter_status_score = await asyncio.gather(
+        clearbit_new_user_score_checker(user_data=obj_in, request=request),
+        hunter_user_email_checker(user_data=obj_in))
+
+    if clearbit_user_score != 'high' and not hunter_status_score:
+        return await save_new_user(db=db, obj_in=obj_in, user_status=USER_STATUS_ACTIVE)
     elif clearbit_user_score == 'high':
-        print('Please enter the captcha and confirm your email')
+        raise HTTPException(status_code=400, detail='Please enter the captcha and confirm your email')
     elif hunter_status_score:
         raise HTTPException(status_code=400, detail='Email is invalid')
 
-    if user_in_db.username == obj_in.username:
-        raise HTTPException(status_code=400, detail='Username already exists')
 
-    if user_in_db.email == obj_in.email:
-        raise HTTPException(status_code=400, detail='Email already exists')
+async def save_new_user(db: AsyncSession, obj_in: UserCreate, user_status: str) -> User:
+    """Записывает нового юзера в бд с указанным статусом. Кэшированные данные юзера с тем же логином
+    (например удаленного аккаунта) сбрасываются"""
+    new_data = obj_in.dict()
+    new_data.pop('password')
+    db_obj = User(**new_data, status=user_status)
+    db_obj.hashed_password = await create_hashed_user_password(obj_in.password)
+    try:
+        db.add(db_obj)
+        await db.commit()
+        await forget_unknown_login(db_obj.username)
+        await invalidate_user_principal(db_obj.username)
+        return db_obj
+    except SQLAlchemyError as err:
+        logger.exception(err)
+
 
+def enqueue_users_verification() -> None:
+    """Ставит таску проверки новых аккаунтов в фоновом потоке, чтобы ответ на регистрацию не ждал брокер.
+    Если брокер недоступен, то аккаунт подберет периодический запуск таски"""
+    asyncio.get_running_loop().run_in_executor(None, _send_users_verification_task)
 
-def user_uniqueness_check(db: Session, user_data: UserCreate):
+
+def _send_users_verification_task() -> None:
+    # celery импортируется только при асинхронной проверке, остальным воркерам апи он не нужен
+    from config.celery_utils import create_celery
+
+    try:
+        create_celery().send_task('verify_pending_users', retry=False)
+    except Exception as err:
+        logger.error(err)
+
+
+async def user_uniqueness_check(db: AsyncSession, user_data: UserCreate):
     """Возвращает из бд юзера(если он есть) для проверки на уникальность данных при регистрации"""
     try:
         user_query = select(User).where(or_(User.username == user_data.username, User.email == user_data.email))
-        user_db_request = db.execute(user_query)
+        user_db_request = await db.execute(user_query)
         return user_db_request.scalar()
     except SQLAlchemyError as err:
         logger.exception(err)
 
 
-def fetch_user_from_db(db: Session, data):
-    """Возвращает юзера по указанному логину"""
+async def authenticate_user(db: AsyncSession, username: str, password: str) -> dict:
+    """Проверяет логин и пароль и выдает токен. Юзер загружается из бд одним запросом только с нужными полями.
+    Несуществующие логины и логины с серией неверных паролей отсекаются по кэшу до запроса в бд и bcrypt"""
+    credentials_exception = HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail='Bad credentials')
+    await check_login_allowed(username)
+
     try:
-        return db.query(User).where(User.username == data.username).first()
+        user = (await db.execute(select(User.id, User.hashed_password, User.status)
+                                 .where(User.username == username))).first()
     except SQLAlchemyError as err:
         logger.exception(err)
+        raise credentials_exception
+    if user is None:
+        await remember_unknown_login(username)
+        raise credentials_exception
+
+    verified, new_hash = await verify_password(password, user.hashed_password)
+    if not verified:
+        await register_login_failure(username)
+        raise credentials_exception
+    await reset_login_failures(username)
+    if user.status == USER_STATUS_FLAGGED:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail='Account is flagged')
+    if new_hash:
+        await update_user_hashed_password(db=db, user_id=user.id, hashed_password=new_hash)
+
+    return {"access_token": create_token(sub=username, uid=user.id), "token_type": "bearer"}
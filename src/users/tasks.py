@@ -0,0 +1,82 @@
+import asyncio
+import logging
+
+from celery import shared_task
+from sqlalchemy import select, update
+from sqlalchemy.exc import SQLAlchemyError
+
+from users.cache import add_principal_invalidation
+from users.models import User, USER_STATUS_PENDING, USER_STATUS_ACTIVE, USER_STATUS_FLAGGED
+from users.schemas import UserCreate
+from users.validators import clearbit_new_user_score_checker, hunter_user_email_checker, close_http_session
+from config.db import SessionLocal as db
+from config.base import settings
+from config.base import manager
+
+redis = manager.sync_redis
+
+logger = logging.getLogger('app.users.tasks')
+
+VERIFICATION_LOCK = 'users:verification:lock'
+
+
+@shared_task(name='verify_pending_users', rate_limit=settings.SIGNUP_VERIFICATION_RATE_LIMIT)
+def verify_pending_users() -> None:
+    """Проверяет через hunter/clearbit пачку аккаунтов в статусе pending, созданных при включенной
+    SIGNUP_ASYNC_VERIFICATION. Прошедшие проверку становятся active, остальные flagged"""
+    lock_timeout = settings.EXTERNAL_API_TIMEOUT * settings.SIGNUP_VERIFICATION_BATCH_SIZE
+    lock = redis.lock(VERIFICATION_LOCK, timeout=lock_timeout, blocking=False)
+    if not lock.acquire():
+        return
+
+    try:
+        users = db.execute(select(User.id, User.username, User.email)
+                           .where(User.status == USER_STATUS_PENDING)
+                           .order_by(User.id)
+                           .limit(settings.SIGNUP_VERIFICATION_BATCH_SIZE)).all()
+        if not users:
+            return
+
+        statuses = asyncio.run(check_users(users=users))
+        for new_status in (USER_STATUS_ACTIVE, USER_STATUS_FLAGGED):
+            user_ids = [user.id for user, user_status in zip(users, statuses) if user_status == new_status]
+            if user_ids:
+                db.execute(update(User).where(User.id.in_(user_ids)).values(status=new_status))
+        db.commit()
+        invalidate_users(usernames=[user.username for user in users])
+        logger.info(f'{len(users)} users verified, {statuses.count(USER_STATUS_FLAGGED)} flagged')
+    except SQLAlchemyError as err:
+        logger.exception(err)
+        db.rollback()
+    finally:
+        lock.release()
+
+
+async def check_users(users: list) -> list[str]:
+    """Одновременно (не больше SIGNUP_VERIFICATION_CONCURRENCY) проверяет юзеров и возвращает их новые статусы.
+    Соединения открываются в event loop этого вызова, поэтому в конце закрываются"""
+    semaphore = asyncio.Semaphore(settings.SIGNUP_VERIFICATION_CONCURRENCY)
+
+    async def check(user) -> str:
+        user_data = UserCreate.construct(username=user.username, email=user.email)
+        async with semaphore:
+            clearbit_user_score, hunter_status_score = await asyncio.gather(
+                clearbit_new_user_score_checker(user_data=user_data, request=None),
+                hunter_user_email_checker(user_data=user_data))
+        if clearbit_user_score == 'high' or hunter_status_score:
+            return USER_STATUS_FLAGGED
+        return USER_STATUS_ACTIVE
+
+    try:
+        return await asyncio.gather(*(check(user) for user in users))
+    finally:
+        await close_http_session()
+        await manager.redis.connection_pool.disconnect()
+
+
+def invalidate_users(usernames: list[str]) -> None:
+    """Сбрасывает данные юзеров из кэшей апи, чтобы новый статус применился сразу"""
+    pipe = redis.pipeline(transaction=False)
+    for username in usernames:
+        add_principal_invalidation(pipe, username)
+    pipe.execute()
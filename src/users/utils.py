@@ -4,49 +4,44 @@ from datetime import timedelta, datetime
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
 from jose import jwt, JWTError
-from passlib.context import CryptContext
+from sqlalchemy import update
 from sqlalchemy.exc import SQLAlchemyError
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from config.db import get_db
-from users.models import User
-from users.schemas import TokenData
+from users.cache import get_user_principal
+from users.models import User, USER_STATUS_FLAGGED
+from users.passwords import hash_password
+from users.schemas import TokenData, UserPrincipal
 from config.base import settings
 
 logger = logging.getLogger('app.users.utils')
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="api/users/login")
 
 
-def create_hashed_user_password(password: str) -> str:
-    """Хэширует пароль"""
-    hashed_password = pwd_context.hash(password)
-    return hashed_password
+async def create_hashed_user_password(password: str) -> str:
+    """Хэширует пароль. Bcrypt выполняется в отдельном пуле процессов, чтобы не блокировать event loop"""
+    return await hash_password(password)
 
 
-def verify_user_password(user_credentials, db: Session = Depends(get_db)):
-    """ Сравнивает пароль который юзер ввел при входе с тем хэшированным паролем в базе"""
-    hashed_pass = get_user_hashed_password_from_db(username=user_credentials.username, db=db)
-    if not pwd_context.verify(user_credentials.password, hashed_pass):
-        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail='Bad Credentials')
-    return user_credentials
-
-
-def get_user_hashed_password_from_db(username: int, db: Session = Depends(get_db)):
-    """Возвращает хэшированный пароль из БД"""
+async def update_user_hashed_password(db: AsyncSession, user_id: int, hashed_password: str) -> None:
+    """Сохраняет пересчитанный хэш пароля"""
     try:
-        user = db.query(User).filter(User.username == username).first()
-        return user.hashed_password
+        await db.execute(update(User).where(User.id == user_id).values(hashed_password=hashed_password))
+        await db.commit()
     except SQLAlchemyError as err:
         logger.exception(err)
+        await db.rollback()
 
 
-def create_token(sub: str):
-    """Создает JWT токен"""
+def create_token(sub: str, uid: int | None = None):
+    """Создает JWT токен. В uid кладется айди юзера, по нему токен привязывается к конкретному аккаунту"""
     token_type = "access_token"
     lifetime = timedelta(minutes=int(settings.ACCESS))
     payload = {'token': token_type, 'exp': datetime.now() + lifetime, 'sub': sub}
+    if uid is not None:
+        payload['uid'] = uid
 
     try:
         return jwt.encode(payload, settings.SECRET, settings.ALGORITHM)
@@ -54,8 +49,8 @@ def create_token(sub: str):
         logger.exception(err)
 
 
-def get_current_user(db: Session = Depends(get_db), token: str = Depends(oauth2_scheme)):
-    """Декодирует JWT и если все ок, то возвращает текущего юзера"""
+def decode_token(token: str) -> TokenData:
+    """Декодирует JWT и возвращает логин и айди юзера из него. Если токен невалидный, то вернет код 401"""
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
@@ -68,11 +63,28 @@ def get_current_user(db: Session = Depends(get_db), token: str = Depends(oauth2_
         if username is None:
             raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail='Could not validate credentials')
 
-        token_data = TokenData(username=username)
+        return TokenData(username=username, id=payload.get('uid'))
     except JWTError:
         raise credentials_exception
 
-    user = db.query(User).filter(User.username == token_data.username).first()
-    if user is None:
-        raise credentials_exception
+
+async def get_current_principal(db: AsyncSession = Depends(get_db),
+                                token: str = Depends(oauth2_scheme)) -> UserPrincipal:
+    """Декодирует JWT и возвращает текущего юзера без проверки статуса аккаунта, чтобы pending и flagged юзеры
+    могли узнать свой статус. Юзер берется из кэша, в бд идет только при промахе. Если айди юзера в токене
+    не совпадает с найденным (аккаунт удален и логин занят заново), то токен не принимается"""
+    token_data = decode_token(token)
+    user = await get_user_principal(db=db, username=token_data.username)
+    if user is None or (token_data.id is not None and token_data.id != user.id):
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Could not validate credentials",
+                            headers={"WWW-Authenticate": "Bearer"})
     return user
+
+
+async def get_current_user(db: AsyncSession = Depends(get_db), token: str = Depends(oauth2_scheme)) -> UserPrincipal:
+    """Возвращает текущего юзера как get_current_principal. Для flagged аккаунта вернет код 403"""
+    user = await get_current_principal(db=db, token=token)
+    if user.status == USER_STATUS_FLAGGED:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail='Account is flagged')
+    return user
+
@@ -1,48 +1,114 @@
+import asyncio
 import json
 import logging
 
 from fastapi import Request
+from redis.exceptions import RedisError
 import aiohttp as aiohttp
 
 from users.schemas import UserCreate
-from config.base import settings
+from config.base import manager, settings
 
+redis = manager.redis
 logger = logging.getLogger('app.users.validators')
 
+# Ответ hunter для емейла, который прошел проверку. Хранится в кэше, чтобы отличать его от отсутствия записи
+VALID_EMAIL = 'valid'
+
+_session: aiohttp.ClientSession | None = None
+
+
+def get_http_session() -> aiohttp.ClientSession:
+    """Общая на весь воркер сессия aiohttp: соединения с внешними апи переиспользуются между запросами"""
+    global _session
+    if _session is None or _session.closed:
+        _session = aiohttp.ClientSession(
+            timeout=aiohttp.ClientTimeout(total=settings.EXTERNAL_API_TIMEOUT,
+                                          connect=settings.EXTERNAL_API_CONNECT_TIMEOUT),
+            connector=aiohttp.TCPConnector(limit=settings.EXTERNAL_API_CONNECTIONS, ttl_dns_cache=300),
+        )
+    return _session
+
+
+async def close_http_session() -> None:
+    """Закрывает общую сессию при остановке приложения"""
+    if _session is not None:
+        await _session.close()
+
+
+def verdict_key(service: str, value: str) -> str:
+    """Ключ закэшированного ответа внешнего сервиса по емейлу или домену"""
+    return f'verdict:{service}:{value.lower()}'
+
+
+async def get_cached_verdict(*keys: str) -> str | None:
+    """Возвращает первый найденный в кэше ответ по ключам"""
+    try:
+        return next((verdict for verdict in await redis.mget(*keys) if verdict), None)
+    except RedisError as err:
+        logger.error(err)
+
+
+async def cache_verdict(key: str, verdict: str) -> None:
+    try:
+        await redis.set(key, verdict, ex=settings.SIGNUP_VERDICT_TTL)
+    except RedisError as err:
+        logger.error(err)
+
 
 async def clearbit_new_user_score_checker(user_data: UserCreate, request: Request) -> str:
-    """Возвращает риск score от clearbit на основе указанного пользователем емейла и его айпи"""
+    """Возвращает риск score от clearbit на основе указанного пользователем емейла и его айпи.
+    Ответ кэшируется по емейлу"""
+    key = verdict_key('clearbit', user_data.email)
+    cached = await get_cached_verdict(key)
+    if cached:
+        return cached
+
     headers = {'Authorization': f'Bearer {settings.CLEARBIT_API_KEY}'}
     params = {'email': user_data.email,
               'ip': '127.0.0.1'}
 
-    async with aiohttp.ClientSession() as session:
-        try:
-            async with session.post(settings.CLEARBIT_URL, data=params, headers=headers) as resp:
-                clearbit_data = await resp.text()
-                clean_data = json.loads(clearbit_data)
-                clearbit_user_risk_level = clean_data['risk']['level']
-                return clearbit_user_risk_level
-        except aiohttp.ClientConnectorError as err:
-            logger.exception(err)
+    try:
+        async with get_http_session().post(settings.CLEARBIT_URL, data=params, headers=headers) as resp:
+            clearbit_data = await resp.text()
+            clean_data = json.loads(clearbit_data)
+            clearbit_user_risk_level = clean_data['risk']['level']
+    except (aiohttp.ClientError, asyncio.TimeoutError, ValueError, KeyError, TypeError) as err:
+        logger.exception(err)
+        return None
+
+    await cache_verdict(key, clearbit_user_risk_level)
+    return clearbit_user_risk_level
 
 
 async def hunter_user_email_checker(user_data: UserCreate) -> str:
-    """Возвращает ответ если указанный при регистрации емейл невалидный на основе проверки сервиса Hunter.io"""
+    """Возвращает ответ если указанный при регистрации емейл невалидный на основе проверки сервиса Hunter.io.
+    Ответ кэшируется по емейлу, а если невалиден сам домен (одноразовая почта или нет MX записей), то по домену"""
+    domain = user_data.email.rsplit('@', 1)[-1]
+    email_key, domain_key = verdict_key('hunter', user_data.email), verdict_key('hunter-domain', domain)
+    cached = await get_cached_verdict(domain_key, email_key)
+    if cached:
+        return None if cached == VALID_EMAIL else cached
+
     params = {'email': user_data.email, 'api_key': settings.HUNTER_API_KEY}
 
-    async with aiohttp.ClientSession() as session:
-        try:
-            async with session.get(settings.HUNTER_URL, params=params) as resp:
-                hunter_data = await resp.text()
-                clean_data = json.loads(hunter_data)
-                email_validation_error = clean_data.get('errors')
-                if email_validation_error:
-                    return 'Invalid email'
-                else:
-                    hunter_user_email_score = clean_data['data']['status']
-                    if hunter_user_email_score in ['invalid', 'unknown']:
-                        return 'Invalid email'
-
-        except aiohttp.ClientConnectorError as err:
-            logger.exception(err)
+    try:
+        async with get_http_session().get(settings.HUNTER_URL, params=params) as resp:
+            hunter_data = await resp.text()
+            clean_data = json.loads(hunter_data)
+            email_validation_error = clean_data.get('errors')
+            if email_validation_error:
+                return 'Invalid email'
+            else:
+                verdict = VALID_EMAIL
+                if clean_data['data']['status'] in ['invalid', 'unknown']:
+                    verdict = 'Invalid email'
+                if clean_data['data'].get('disposable') or clean_data['data'].get('mx_records') is False:
+                    await cache_verdict(domain_key, 'Invalid email')
+                    verdict = 'Invalid email'
+    except (aiohttp.ClientError, asyncio.TimeoutError, ValueError, KeyError, TypeError) as err:
+        logger.exception(err)
+        return None
+
+    await cache_verdict(email_key, verdict)
+    return None if verdict == VALID_EMAIL else verdict
@@ -0,0 +1,31 @@
+import logging
+
+from celery.signals import worker_init, worker_shutdown
+from redis.exceptions import RedisError
+
+from config.base import settings
+from config.celery_utils import create_celery
+from config.logging_utils import configure_logging
+
+configure_logging()
+logger = logging.getLogger('app.worker')
+
+celery = create_celery()
+celery.conf.imports = ['posts.tasks', 'users.tasks']
+
+
+@worker_init.connect
+def check_settings(**kwargs) -> None:
+    """Воркер проверяет регистрации через hunter/clearbit, beat и flower ключи не нужны"""
+    settings.check_external_api_keys()
+
+
+@worker_shutdown.connect
+def flush_reactions_journal(**kwargs) -> None:
+    """При остановке воркера переносит в бд журнал лайков, не дожидаясь следующего запуска update_db"""
+    from posts.tasks import update_db
+
+    try:
+        update_db()
+    except RedisError as err:
+        logger.error(err)